@@ -1,206 +1,434 @@
-import socket
+import itertools
 import json
+import queue
+import selectors
+import socket
 import threading
 
+# Frames are newline terminated, json.dumps never produces a raw newline
+frame_delimiter = b"\n"
+
 
 class ContextSwitcher:
     def __init__(self, host, port, username, is_client):
-        self.client_server = ClientServer(host, port)
+        node = PeerNode.shared()
         if is_client:
-            self.client_server.start_as_client()
+            stream = node.connect(host, port, username)
         else:
-            self.client_server.start_as_server()
+            node.listen(host, port)
+            print("Waiting for a connection...")
+            stream = node.accept_stream()
+            stream.username = username
 
-        self.client_server_controller = ClientServerController(self.client_server, username)
-        self.message_view = MessageView(self.client_server_controller)
+        self.message_view = MessageView(stream)
 
         self.message_view.activate()
 
 
 class MessageView:
-    def __init__(self, client_server_controller):
-        self.client_server_controller = client_server_controller
+    def __init__(self, stream):
+        self.stream = stream
 
     def activate(self):
-        while self.client_server_controller.is_closed is False:
+        while self.stream.is_closed is False:
             message = input("")
 
-            if self.client_server_controller.is_closed is True:
+            if self.stream.is_closed is True:
                 break
 
             if message == "quit":
-                response = self.client_server_controller.quit()
-                self.client_server_controller.close()
+                response = self.stream.quit()
+                self.stream.close()
                 break
 
-            response = self.client_server_controller.send(message)
+            response = self.stream.send(message)
             if response["status"] == "failure":
                 print(response["message"])
 
 
-class ClientServerController:
-    def __init__(self, client_server, username):
-        self.username = username
-        self.client_server = client_server
-        self.request_helper = RequestHelper(client_server, self)
-        self.is_closed = False
-
-    def send(self, message):
-        return self.request_helper.request({"command": "message", "username": self.username, "message": message})
-    
-    def quit(self):
-        return self.request_helper.request({"command": "quit"})
-    
-    def close(self):
-        self.is_closed = True
-        self.request_helper.stop()
-        self.client_server.close()
-
-
 class Command:
-    def __init__(self, client_server, data):
+    def __init__(self, stream, data):
         self.data = data
-        self.client_server = client_server
+        self.stream = stream
 
     def respond(self, data):
         data["ID"] = self.data["ID"]
-        self.client_server.send(data)
+        self.stream.write(data)
 
     def execute(self):
         pass
 
 
 class MessageCommand(Command):
-    def __init__(self, client_server, data):
-        super().__init__(client_server, data)
-        self.data = data
-
     def execute(self):
-        print(f"{self.data['username']}: {self.data['message']}")
+        self.stream.on_message(self.data)
         self.respond({"status": "success"})
 
 
 class QuitCommand(Command):
-    def __init__(self, client_server, data, client_server_controller):
-        super().__init__(client_server, data)
-        self.data = data
-        self.client_server_controller = client_server_controller
-
     def execute(self):
         self.respond({"status": "success"})
-        self.client_server_controller.close()
+        self.stream.close()
 
 
 class CommandFactory:
     @staticmethod
-    def create_command(data, client_server, request_helper, client_server_controller):
+    def create_command(data, stream):
         command = data["command"]
 
         if command == "message":
-            return MessageCommand(client_server, data)
+            return MessageCommand(stream, data)
         elif command == "quit":
-            return QuitCommand(client_server, data, client_server_controller)
+            return QuitCommand(stream, data)
         else:
             return None
 
 
-class RequestHelper:
+def print_message(data):
+    print(f"{data['username']}: {data['message']}")
+
+
+class Stream:
+    """One direct chat. Any number of them share the single connection to a peer."""
+
     timeout = 60
-    id = 0
 
-    def __init__(self, client_server, client_server_controller):
-        self.client_server_controller = client_server_controller
-        self.client_server = client_server
+    def __init__(self, connection, stream_id, username, on_message=print_message):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.username = username
+        self.on_message = on_message
+        self.ids = itertools.count(1)
         self.event_pool = {}
+        self.is_closed = False
 
-        self.stop_event = threading.Event()
-        threading.Thread(target=self.listen).start()
+    def write(self, data):
+        data["stream"] = self.stream_id
+        self.connection.send(data)
 
     def request(self, data):
-        self.id += 1
-        data["ID"] = self.id
-        self.client_server.send(data)
-
-        self.event_pool[self.id] = threading.Event()
-        flag = self.event_pool[self.id].wait(self.timeout)
+        if self.is_closed:
+            return {"status": "failure", "message": "Chat closed"}
+        request_id = next(self.ids)
+        data["ID"] = request_id
+
+        # Registered before sending so a fast response is never missed
+        event = threading.Event()
+        self.event_pool[request_id] = event
+        self.write(data)
+        flag = event.wait(self.timeout)
+        self.event_pool.pop(request_id, None)
 
         if flag:
-            response = self.event_pool[self.id]
-            del self.event_pool[self.id]
-            return response
+            return event.response
         else:
             return {"status": "failure", "message": "Request timed out"}
 
-    def listen(self):
-        while not self.stop_event.is_set():
-            response = self.client_server.receive()
-
-            if response.get("ID") in self.event_pool:
-                event = self.event_pool[response["ID"]]
-                self.event_pool[response["ID"]] = response
-                event.set()
-            elif response.get("command"):
-                CommandFactory.create_command(response, self.client_server, self, self.client_server_controller).execute()
+    def handle(self, data):
+        if data.get("command"):
+            # The peer numbers its requests on its own, only responses match ours
+            command = CommandFactory.create_command(data, self)
+            if command is not None:
+                command.execute()
+            return
 
+        waiting = self.event_pool.pop(data.get("ID"), None)
+        if waiting is not None:
+            waiting.response = data
+            waiting.set()
 
-    def stop(self):
-        self.stop_event.set()
-
+    def send(self, message):
+        return self.request({"command": "message", "username": self.username, "message": message})
 
-class ClientServer:
-    buffer_size = 2048
+    def quit(self):
+        return self.request({"command": "quit"})
 
-    def __init__(self, host, port):
-        self.host = host
-        self.port = port
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.connection.forget(self)
+        for event in list(self.event_pool.values()):
+            event.response = {"status": "failure", "message": "Chat closed"}
+            event.set()
 
-        # Create a TCP/IP socket
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    def start_as_client(self):
-        # Connect the socket to the server
-        self.client_socket.connect((self.host, self.port))
-        print(f"Client started on {self.host}:{self.port}...")
+class PeerConnection:
+    """The one socket to a peer, frames carry the stream they belong to.
 
-    def start_as_server(self):
-        # Bind the socket to the port
-        self.client_socket.bind((self.host, self.port))
-        print(f"Server started on {self.host}:{self.port}...")
+    The side that dialled numbers its streams odd and the side that accepted
+    even, so both can open streams at once without agreeing on ids first.
+    """
 
-        # Listen for incoming connections
-        self.client_socket.listen(1)
+    buffer_size = 2048
+    # Bytes waiting for a peer that stopped reading before it is dropped
+    max_queued_bytes = 1024 * 1024
+
+    def __init__(self, node, peer_socket, initiator):
+        self.node = node
+        self.peer_socket = peer_socket
+        # Never blocks, what the socket does not take waits in outgoing for the node thread
+        self.peer_socket.setblocking(False)
+        self.streams = {}
+        self.stream_ids = itertools.count(1 if initiator else 2, 2)
+        self.buffer = b""
+        self.outgoing = b""
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.closed = False
 
-        # Wait for a connection
-        print("Waiting for a connection...")
-        self.client_socket, self.client_address = self.client_socket.accept()
-        print(f"Connected to {self.client_address}")
+    def send(self, data):
+        frame = json.dumps(data).encode("utf-8") + frame_delimiter
+        with self.send_lock:
+            overflow = len(self.outgoing) + len(frame) > self.max_queued_bytes
+            if not overflow:
+                self.outgoing += frame
+                self.write_available()
+            waiting = bool(self.outgoing)
+        if overflow:
+            print("Error: Dropping a peer that stopped reading")
+            self.node.drop(self)
+        elif waiting:
+            self.node.watch(self)
+
+    def write_available(self):
+        """Writes what the socket takes now. Needs the send lock."""
+        try:
+            sent = self.peer_socket.send(self.outgoing)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # The node thread drops the connection once it reads the end
+            print(f"Socket error: {str(e)}")
+            self.outgoing = b""
+            return
+        self.outgoing = self.outgoing[sent:]
+
+    def flush(self):
+        """Runs on the node thread when the socket can take more."""
+        with self.send_lock:
+            self.write_available()
+
+    def open_stream(self, username):
+        with self.lock:
+            stream = Stream(self, next(self.stream_ids), username)
+            self.streams[stream.stream_id] = stream
+        stream.write({"command": "open", "username": username})
+        return stream
+
+    def forget(self, stream):
+        with self.lock:
+            self.streams.pop(stream.stream_id, None)
+
+    def receive_available(self):
+        """Reads once from a readable socket, returns None once the peer is gone."""
+        try:
+            received = self.peer_socket.recv(self.buffer_size)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            return None
+        if not received:
+            return None
+        self.buffer += received
+        *frames, self.buffer = self.buffer.split(frame_delimiter)
+        return [json.loads(frame) for frame in frames]
+
+    def dispatch(self, data):
+        command = data.get("command")
+        if command == "hello":
+            # The peer's own listening address, later chats to it reuse this socket
+            self.node.remember(tuple(data["listen"]), self)
+            return
+        if command == "open":
+            # Named by whoever picks the chat up
+            stream = Stream(self, data["stream"], None)
+            with self.lock:
+                self.streams[stream.stream_id] = stream
+            self.node.incoming.put(stream)
+            return
+
+        with self.lock:
+            stream = self.streams.get(data.get("stream"))
+        if stream is not None:
+            stream.handle(data)
 
-    def process_before_sending(self, data):
-        return json.dumps(data).encode("utf-8")
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            streams = list(self.streams.values())
+        for stream in streams:
+            stream.close()
+        self.peer_socket.close()
+
+
+class PeerNode:
+    """Every direct chat this client has, on one thread.
+
+    One listening socket accepts peers without blocking anybody, and one
+    connection per peer carries all chats with it.
+    """
+
+    backlog = 16
+    # Seconds to wait for a peer to answer a dial
+    connect_timeout = 10
+    default = None
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.listen_address = None
+        self.incoming = queue.Queue()
+
+        # Lets other threads interrupt a select that is already running
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, None)
+        self.stop_event = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
 
-    def process_received(self, data):
-        return json.loads(data.decode())
+    @classmethod
+    def shared(cls):
+        if cls.default is None:
+            cls.default = cls()
+        return cls.default
 
-    def send(self, data):
+    def wakeup(self):
         try:
-            self.client_socket.send(self.process_before_sending(data))
-        except socket.error as e:
-            print(f"Socket error: {str(e)}")
-        except Exception as e:
-            print(f"Other exception: {str(e)}")
+            self.wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def listen(self, host, port):
+        with self.lock:
+            if self.listen_address is not None:
+                return
+            listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listen_socket.bind((host, port))
+            listen_socket.listen(self.backlog)
+            listen_socket.setblocking(False)
+            self.listen_address = (host, port)
+            self.selector.register(listen_socket, selectors.EVENT_READ, listen_socket)
+        print(f"Listening for peers on {host}:{port}...")
+        self.wakeup()
+
+    def watch(self, connection):
+        """Has the node thread look for the socket being writable while output waits."""
+        with self.lock:
+            if connection.closed:
+                return
+            events = selectors.EVENT_READ
+            if connection.outgoing:
+                events |= selectors.EVENT_WRITE
+            try:
+                if self.selector.get_key(connection.peer_socket).events != events:
+                    self.selector.modify(connection.peer_socket, events, connection)
+            except (KeyError, ValueError):
+                return
+        self.wakeup()
+
+    def remember(self, address, connection):
+        with self.lock:
+            self.connections.setdefault(address, connection)
+
+    def connect(self, host, port, username):
+        """Opens a chat with the peer listening on host and port, over its existing connection if there is one."""
+        with self.lock:
+            connection = self.connections.get((host, port))
+        if connection is None or connection.closed:
+            # Dialled without the lock, the node thread keeps accepting and reading meanwhile
+            peer_socket = socket.create_connection((host, port), timeout=self.connect_timeout)
+            dialled = PeerConnection(self, peer_socket, initiator=True)
+            with self.lock:
+                connection = self.connections.get((host, port))
+                if connection is None or connection.closed:
+                    connection = dialled
+                    self.connections[(host, port)] = connection
+                    self.selector.register(peer_socket, selectors.EVENT_READ, connection)
+            if connection is not dialled:
+                # Another chat got there first, both share its connection
+                peer_socket.close()
+            else:
+                print(f"Connected to {host}:{port}")
+                if self.listen_address is not None:
+                    connection.send({"command": "hello", "listen": list(self.listen_address)})
+        self.wakeup()
+        return connection.open_stream(username)
+
+    def accept_stream(self, timeout=None):
+        """Blocks only the caller until a peer opens a chat with us."""
+        try:
+            return self.incoming.get(timeout=timeout)
+        except queue.Empty:
+            return None
 
-    def receive(self):
+    def accept_all(self, listen_socket):
+        while True:
+            try:
+                peer_socket, address = listen_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of descriptors, the peer is accepted on a later turn
+                print(f"Error: Failed to accept a peer - {e}")
+                return
+            print(f"Connected to {address}")
+            connection = PeerConnection(self, peer_socket, initiator=False)
+            with self.lock:
+                self.selector.register(peer_socket, selectors.EVENT_READ, connection)
+
+    def drop(self, connection):
+        with self.lock:
+            try:
+                self.selector.unregister(connection.peer_socket)
+            except (KeyError, ValueError):
+                pass
+            for address, known in list(self.connections.items()):
+                if known is connection:
+                    del self.connections[address]
+        connection.close()
+
+    def serve(self, connection):
+        # One peer sending garbage must not take down the thread every chat runs on
         try:
-            response_data = self.client_socket.recv(self.buffer_size)
-            return self.process_received(response_data)
+            frames = connection.receive_available()
+            if frames is None:
+                self.drop(connection)
+                return
+            for data in frames:
+                connection.dispatch(data)
         except Exception as e:
-            print(f"Other exception: {str(e)}")
-            return {"status": "failure", "message": "Error receiving data"}
+            print(f"Error: Dropping peer after a bad frame - {e}")
+            self.drop(connection)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    self.wakeup_receiver.recv(4096)
+                elif isinstance(key.data, PeerConnection):
+                    if mask & selectors.EVENT_WRITE:
+                        key.data.flush()
+                        self.watch(key.data)
+                    if mask & selectors.EVENT_READ:
+                        self.serve(key.data)
+                else:
+                    self.accept_all(key.data)
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup()
+        with self.lock:
+            watched = [key.data for key in self.selector.get_map().values()]
+        # Peer connections and the listening socket
+        for data in watched:
+            if data is not None:
+                data.close()
 
-    def close(self):
-        print("Closing connection to the server")
-        self.client_socket.close()
 
 if __name__ == "__main__":
     ContextSwitcher("localhost", 20, "Bob", True)  # Change the IP address and port as needed
@@ -0,0 +1,212 @@
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import threading
+
+# magic, number of slots, accounts indexed, how much of the log the index covers
+index_header = struct.Struct("<8sQQQ")
+index_magic = b"ACCTIDX1"
+# hash of the username, offset of its record in the log plus one, zero is free
+index_slot = struct.Struct("<QQ")
+# username length, password length
+record_header = struct.Struct("<HH")
+
+
+class Credentials:
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+
+def name_hash(username):
+    return int.from_bytes(hashlib.blake2b(username.encode(), digest_size=8).digest(), "little")
+
+
+class AccountStore:
+    """Accounts in an append-only log, found through an open-addressing hash index mapped into memory.
+
+    Opening reads neither file in full: a lookup probes a few slots of the
+    index and reads one record, and each record is decoded once and then
+    cached. The log is the source of truth, an index that fell behind after a
+    crash or another process's writes is brought up to date from its tail.
+    """
+
+    initial_slots = 1024
+    max_load = 0.5
+
+    def __init__(self, path):
+        self.log_path = path + ".log"
+        self.index_path = path + ".idx"
+        self.lock = threading.RLock()
+        self.cache = {}
+        self.log = None
+        self.index_file = None
+        self.index = None
+        self.open()
+
+    def open(self):
+        self.log = open(self.log_path, "a+b")
+        if not self.map_index():
+            self.create_index(self.initial_slots)
+        self.catch_up()
+
+    def reopen(self):
+        """Picks up what another process wrote, it may have replaced the index file since."""
+        with self.lock:
+            self.close()
+            self.cache = {}
+            self.open()
+
+    def map_index(self):
+        if not os.path.exists(self.index_path):
+            return False
+        self.index_file = open(self.index_path, "r+b")
+        size = os.fstat(self.index_file.fileno()).st_size
+        if size < index_header.size:
+            self.index_file.close()
+            return False
+        self.index = mmap.mmap(self.index_file.fileno(), size)
+        magic, self.slots, self.count, self.indexed = index_header.unpack_from(self.index)
+        if magic != index_magic or size != index_header.size + self.slots * index_slot.size:
+            self.index.close()
+            self.index_file.close()
+            return False
+        return True
+
+    def create_index(self, slots):
+        """Writes an empty index of the given size next to the old one and swaps it in."""
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(index_header.pack(index_magic, slots, 0, 0))
+            file.truncate(index_header.size + slots * index_slot.size)
+        os.replace(temporary_path, self.index_path)
+        if self.index is not None:
+            self.index.close()
+            self.index_file.close()
+        self.index_file = open(self.index_path, "r+b")
+        self.index = mmap.mmap(self.index_file.fileno(), index_header.size + slots * index_slot.size)
+        self.slots = slots
+        self.indexed = 0
+        self.count = 0
+
+    def slot_offset(self, slot):
+        return index_header.size + slot * index_slot.size
+
+    def probe(self, hashed):
+        slot = hashed & (self.slots - 1)
+        while True:
+            yield slot
+            slot = (slot + 1) & (self.slots - 1)
+
+    def read_record(self, offset):
+        header = os.pread(self.log.fileno(), record_header.size, offset)
+        name_length, password_length = record_header.unpack(header)
+        body = os.pread(self.log.fileno(), name_length + password_length, offset + record_header.size)
+        return Credentials(body[:name_length].decode(), body[name_length:].decode())
+
+    def lookup(self, username):
+        with self.lock:
+            credentials = self.cache.get(username)
+            if credentials is not None:
+                return credentials
+
+            hashed = name_hash(username) or 1
+            for slot in self.probe(hashed):
+                stored_hash, location = index_slot.unpack_from(self.index, self.slot_offset(slot))
+                if location == 0:
+                    return None
+                if stored_hash == hashed:
+                    credentials = self.read_record(location - 1)
+                    if credentials.username == username:
+                        self.cache[username] = credentials
+                        return credentials
+
+    def insert(self, username, offset):
+        if self.count + 1 > self.slots * self.max_load:
+            self.grow()
+        hashed = name_hash(username) or 1
+        for slot in self.probe(hashed):
+            if index_slot.unpack_from(self.index, self.slot_offset(slot))[1] == 0:
+                index_slot.pack_into(self.index, self.slot_offset(slot), hashed, offset + 1)
+                self.count += 1
+                return
+
+    def grow(self):
+        # Rebuilt from the log into a table twice the size, amortised over the inserts that filled it
+        indexed = self.indexed
+        self.create_index(self.slots * 2)
+        self.index_log(0, indexed)
+
+    def index_log(self, start, end):
+        offset = start
+        while offset < end:
+            header = os.pread(self.log.fileno(), record_header.size, offset)
+            if len(header) < record_header.size:
+                break
+            name_length, password_length = record_header.unpack(header)
+            next_offset = offset + record_header.size + name_length + password_length
+            if next_offset > end:
+                # Cut off mid-record by a crash, overwritten by the next append
+                break
+            username = os.pread(self.log.fileno(), name_length, offset + record_header.size).decode()
+            self.insert(username, offset)
+            # Kept current record by record, growing re-reads the log up to here
+            offset = self.indexed = next_offset
+        index_header.pack_into(self.index, 0, index_magic, self.slots, self.count, self.indexed)
+
+    def catch_up(self):
+        with self.lock:
+            end = os.fstat(self.log.fileno()).st_size
+            if self.indexed > end:
+                # The index is ahead of a log that was replaced, start over
+                self.create_index(self.initial_slots)
+            if self.indexed < end:
+                self.index_log(self.indexed, end)
+
+    def append(self, accounts):
+        """Makes a group of new accounts durable with one fsync, then indexes them."""
+        records = b"".join(
+            record_header.pack(len(username), len(password)) + username + password
+            for username, password in (
+                (credentials.username.encode(), credentials.password.encode()) for credentials in accounts
+            )
+        )
+        # Only the account writer appends, lookups carry on during the fsync
+        start = self.indexed
+        if os.fstat(self.log.fileno()).st_size != start:
+            # A record torn by a crash, nothing points at it
+            self.log.truncate(start)
+        self.log.write(records)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+        with self.lock:
+            # The index is rebuilt from the log if it is lost, it needs no fsync of its own
+            self.index_log(start, start + len(records))
+            self.index.flush()
+            for credentials in accounts:
+                self.cache[credentials.username] = credentials
+
+    def import_pickle(self, legacy_path):
+        """Moves accounts over from the old whole-file pickle, once."""
+        if self.indexed or not os.path.exists(legacy_path):
+            return 0
+        with open(legacy_path, "rb") as file:
+            try:
+                legacy = pickle.load(file)
+            except (pickle.UnpicklingError, EOFError):
+                return 0
+        accounts = [Credentials(credentials.username, credentials.password) for credentials in legacy.values()]
+        if accounts:
+            self.append(accounts)
+        return len(accounts)
+
+    def close(self):
+        with self.lock:
+            if self.index is not None:
+                self.index.close()
+                self.index_file.close()
+                self.index = None
+            self.log.close()
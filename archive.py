@@ -0,0 +1,255 @@
+import heapq
+import itertools
+import json
+import math
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+# payload length, seconds since the epoch
+record_header = struct.Struct("<Id")
+
+# A message is found by its segment and offset packed into one number, which
+# grows with every append so postings stay sorted without a separate id table
+offset_bits = 40
+
+word_pattern = re.compile(r"\w+")
+
+
+def message_location(segment, offset):
+    return (segment << offset_bits) | offset
+
+
+def split_location(location):
+    return location >> offset_bits, location & ((1 << offset_bits) - 1)
+
+
+def terms_of(text):
+    counts = {}
+    for word in word_pattern.findall(text.lower()):
+        counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+class Postings:
+    """Sorted message locations for one term of one user, and how often the term occurs in each."""
+
+    def __init__(self):
+        self.locations = array("q")
+        self.frequencies = array("B")
+
+    def add(self, location, frequency):
+        frequency = min(frequency, 255)
+        if not self.locations or location > self.locations[-1]:
+            self.locations.append(location)
+            self.frequencies.append(frequency)
+            return
+        # Only records indexed late, after another process wrote them, land here
+        position = bisect_left(self.locations, location)
+        self.locations.insert(position, location)
+        self.frequencies.insert(position, frequency)
+
+    def frequency(self, location):
+        position = bisect_left(self.locations, location)
+        if position < len(self.locations) and self.locations[position] == location:
+            return self.frequencies[position]
+        return 0
+
+
+class UserIndex:
+    def __init__(self):
+        self.terms = {}
+        self.messages = 0
+
+    def add(self, location, counts):
+        self.messages += 1
+        for term, frequency in counts.items():
+            postings = self.terms.get(term)
+            if postings is None:
+                postings = self.terms[term] = Postings()
+            postings.add(location, frequency)
+
+    def matches(self, terms):
+        """(score, location) for messages containing all terms, newest first, scored with tf-idf."""
+        postings = [self.terms.get(term) for term in terms]
+        if not postings or any(entry is None for entry in postings):
+            return
+        # Walk the rarest term and probe the others
+        postings.sort(key=lambda entry: len(entry.locations))
+        rarest, others = postings[0], postings[1:]
+        weights = [math.log(1 + self.messages / len(entry.locations)) for entry in postings]
+
+        for position in range(len(rarest.locations) - 1, -1, -1):
+            location = rarest.locations[position]
+            frequency = rarest.frequencies[position]
+            score = weights[0] * (1 + math.log(frequency))
+            for weight, entry in zip(weights[1:], others):
+                other_frequency = entry.frequency(location)
+                if other_frequency == 0:
+                    break
+                score += weight * (1 + math.log(other_frequency))
+            else:
+                yield score, location
+
+
+class Archive:
+    """Append-only log of relayed messages in segment files, with an in-memory inverted index per user.
+
+    Each process writes its own segments and never appends to an older one, so
+    a process taking over during a restart can index what the old one wrote last.
+    """
+
+    segment_size = 64 * 1024 * 1024
+    # Only the newest matches are ranked, so common words cost the same
+    # whether a user has a thousand messages or millions
+    ranking_window = 5000
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.indexes = {}
+        # How far every segment has been indexed
+        self.indexed = {}
+        # What the snapshot on disk covers, nothing to save while it matches indexed
+        self.saved = None
+        self.readers = {}
+
+        self.load_snapshot()
+        self.catch_up()
+        self.segment = max(self.indexed, default=0) + 1
+        self.file = self.open_segment(self.segment)
+
+    def snapshot_path(self):
+        return os.path.join(self.directory, "index.pkl")
+
+    def load_snapshot(self):
+        # The index as of the last clean close, only what came after is read again
+        if not os.path.exists(self.snapshot_path()):
+            return
+        with open(self.snapshot_path(), "rb") as file:
+            try:
+                self.indexes, self.indexed = pickle.load(file)
+            except (pickle.UnpicklingError, EOFError):
+                self.indexes, self.indexed = {}, {}
+
+    def save_snapshot(self):
+        temporary_path = self.snapshot_path() + ".tmp"
+        with open(temporary_path, "wb") as file:
+            pickle.dump((self.indexes, self.indexed), file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.snapshot_path())
+        self.saved = dict(self.indexed)
+
+    def checkpoint(self):
+        """Saves the index if messages came in since the last save, a crash or kill then re-reads only what followed."""
+        with self.lock:
+            if self.indexed == self.saved:
+                return
+            # The snapshot must not cover records that could still be lost
+            os.fsync(self.file.fileno())
+            self.save_snapshot()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:06d}.log")
+
+    def segments(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith(".log"):
+                numbers.append(int(name[len("segment-"):-len(".log")]))
+        return sorted(numbers)
+
+    def open_segment(self, segment):
+        file = open(self.segment_path(segment), "ab")
+        self.indexed[segment] = file.tell()
+        return file
+
+    def read_records(self, segment, offset):
+        with open(self.segment_path(segment), "rb") as file:
+            file.seek(offset)
+            while True:
+                header = file.read(record_header.size)
+                if len(header) < record_header.size:
+                    return
+                length, timestamp = record_header.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length:
+                    # Cut off mid-record, picked up again by the next catch up
+                    return
+                next_offset = offset + record_header.size + length
+                yield offset, next_offset, json.loads(payload)
+                offset = next_offset
+
+    def catch_up(self):
+        """Indexes whatever other processes appended to segments since the last look."""
+        with self.lock:
+            active = getattr(self, "segment", None)
+            for segment in self.segments():
+                if segment == active:
+                    continue
+                end = self.indexed.get(segment, 0)
+                for offset, end, record in self.read_records(segment, end):
+                    self.index_record(message_location(segment, offset), record)
+                self.indexed[segment] = end
+
+    def index_record(self, location, record):
+        counts = terms_of(record["message"])
+        for username in {record["from"], record["to"]}:
+            index = self.indexes.get(username)
+            if index is None:
+                index = self.indexes[username] = UserIndex()
+            index.add(location, counts)
+
+    def append(self, sender, recipient, message):
+        record = {"from": sender, "to": recipient, "message": message}
+        payload = json.dumps(record).encode()
+
+        with self.lock:
+            if self.indexed[self.segment] + record_header.size + len(payload) > self.segment_size:
+                self.file.close()
+                # Past any segment a process taking over may have started
+                self.segment = max(self.segments()) + 1
+                self.file = self.open_segment(self.segment)
+
+            offset = self.indexed[self.segment]
+            self.file.write(record_header.pack(len(payload), time.time()) + payload)
+            # Hits are read back with pread, so they must be out of the buffer
+            self.file.flush()
+            self.indexed[self.segment] = offset + record_header.size + len(payload)
+            self.index_record(message_location(self.segment, offset), record)
+
+    def read(self, location):
+        segment, offset = split_location(location)
+        descriptor = self.readers.get(segment)
+        if descriptor is None:
+            descriptor = self.readers[segment] = os.open(self.segment_path(segment), os.O_RDONLY)
+        length, timestamp = record_header.unpack(os.pread(descriptor, record_header.size, offset))
+        record = json.loads(os.pread(descriptor, length, offset + record_header.size))
+        record["time"] = timestamp
+        return record
+
+    def search(self, username, query, offset, limit):
+        """One page of the best of a user's newest messages containing every word of query, and how many were ranked."""
+        terms = list(terms_of(query))
+        with self.lock:
+            index = self.indexes.get(username)
+            if index is None or not terms:
+                return [], 0
+            matches = list(itertools.islice(index.matches(terms), self.ranking_window))
+            # Newer messages win ties, their locations are larger
+            page = heapq.nlargest(offset + limit, matches)[offset:]
+            hits = [self.read(location) for _, location in page]
+        return hits, len(matches)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.save_snapshot()
+            for descriptor in self.readers.values():
+                os.close(descriptor)
+            self.readers = {}
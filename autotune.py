@@ -0,0 +1,137 @@
+import math
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+# Payload of a typical relayed chat message, what the frame cost is measured on
+sample_message = {"command": "message", "username": "someone", "message": "see you at eight then", "ID": 42}
+
+
+class LoadProbe:
+    """Measures what the tunable settings depend on, in about a second.
+
+    Nothing here binds a port or touches real data, the probe uses a socket
+    pair and a scratch file next to the account store.
+    """
+
+    read_sizes = (2048, 8192, 32768, 65536)
+    stream_bytes = 8 * 1024 * 1024
+    frames = 2000
+    fsyncs = 10
+
+    def __init__(self, codec_factory, data_directory):
+        self.codec_factory = codec_factory
+        self.data_directory = data_directory
+
+    def run(self):
+        return {
+            "cpus": os.cpu_count() or 1,
+            "open_files": self.open_files(),
+            "somaxconn": self.somaxconn(),
+            "frame_cost": self.frame_cost(),
+            "fsync_latency": self.fsync_latency(),
+            "read_throughput": {size: self.read_throughput(size) for size in self.read_sizes},
+        }
+
+    def open_files(self):
+        try:
+            # Unix only, Windows has no per-process descriptor limit to read
+            import resource
+        except ImportError:
+            return None
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        return None if limit == resource.RLIM_INFINITY else limit
+
+    def somaxconn(self):
+        try:
+            with open("/proc/sys/net/core/somaxconn") as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return None
+
+    def frame_cost(self):
+        """Seconds to encode and decode one compressed frame, a worker's share of relaying a message."""
+        sender, receiver = self.codec_factory(), self.codec_factory()
+        sender.enable_compression()
+        receiver.enable_compression()
+        started = time.perf_counter()
+        for _ in range(self.frames):
+            receiver.decode(sender.encode(sample_message)[:-1])
+        return (time.perf_counter() - started) / self.frames
+
+    def fsync_latency(self):
+        os.makedirs(self.data_directory, exist_ok=True)
+        samples = []
+        with tempfile.TemporaryFile(dir=self.data_directory) as file:
+            for _ in range(self.fsyncs):
+                file.write(b"x" * 64)
+                file.flush()
+                started = time.perf_counter()
+                os.fsync(file.fileno())
+                samples.append(time.perf_counter() - started)
+        return statistics.median(samples)
+
+    def read_throughput(self, read_size):
+        """Bytes per second a reader gets out of a busy socket with recv calls of this size."""
+        reader, writer = socket.socketpair()
+        chunk = b"x" * 65536
+
+        def write():
+            remaining = self.stream_bytes
+            while remaining > 0:
+                writer.sendall(chunk[:remaining])
+                remaining -= len(chunk)
+            writer.shutdown(socket.SHUT_WR)
+
+        thread = threading.Thread(target=write)
+        started = time.perf_counter()
+        thread.start()
+        received = 0
+        while True:
+            data = reader.recv(read_size)
+            if not data:
+                break
+            received += len(data)
+        elapsed = time.perf_counter() - started
+        thread.join()
+        reader.close()
+        writer.close()
+        return received / elapsed
+
+
+def suggest(measurements):
+    """{setting: (value, reason)} for what the measurements say this machine should run with."""
+    suggestions = {}
+    cpus = measurements["cpus"]
+
+    throughput = measurements["read_throughput"]
+    best = max(throughput.values())
+    # The smallest read that gets within a tenth of the best, larger ones only cost memory per connection
+    read_size = min(size for size, rate in throughput.items() if rate >= best * 0.9)
+    suggestions["data_payload"] = (read_size, f"{throughput[read_size] / 2 ** 20:.0f}MB/s, best {best / 2 ** 20:.0f}MB/s")
+
+    if measurements["somaxconn"]:
+        # Anything above somaxconn is silently cut down to it by the kernel
+        suggestions["backlog"] = (measurements["somaxconn"], "net.core.somaxconn")
+
+    if measurements["open_files"]:
+        # A descriptor per connection, with room left for the listener, stores, capture and archive
+        connections = max(64, measurements["open_files"] - 64)
+        suggestions["max_connections"] = (connections, f"open file limit {measurements['open_files']}")
+
+    # Decoding is CPU bound, more readers than cores only contend for the interpreter
+    readers = max(1, min(4, cpus))
+    suggestions["reader_threads"] = (readers, f"{cpus} cpus")
+
+    # Workers block on group commits, keep enough free to serve what arrives during one fsync
+    frame_cost = measurements["frame_cost"]
+    fsync_latency = measurements["fsync_latency"]
+    blocked = math.ceil(fsync_latency / frame_cost) if frame_cost else 0
+    workers = max(4, min(64, 2 * cpus + blocked))
+    suggestions["worker_threads"] = (
+        workers, f"fsync {fsync_latency * 1e3:.2f}ms, frame {frame_cost * 1e6:.0f}us, {cpus} cpus"
+    )
+    return suggestions
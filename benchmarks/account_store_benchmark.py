@@ -0,0 +1,60 @@
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from accounts import AccountStore, Credentials
+
+
+def unpickled(path, username):
+    """What every new connection did before: load the whole file, then scan it."""
+    with open(path, "rb") as file:
+        accounts = pickle.load(file)
+    return any(user.username == username for user in accounts.values())
+
+
+def main(lookups=1000):
+    print(f"{'accounts':<10}{'pickle load ms':>16}{'store open ms':>15}{'first lookup us':>17}{'cached us':>11}")
+    for count in (1000, 10000, 100000, 1000000):
+        with tempfile.TemporaryDirectory() as directory:
+            accounts = [Credentials(f"user{number}", "password") for number in range(count)]
+            legacy_path = os.path.join(directory, "user_data.pkl")
+            with open(legacy_path, "wb") as file:
+                pickle.dump({credentials.username: credentials for credentials in accounts}, file)
+            store = AccountStore(os.path.join(directory, "accounts"))
+            store.append(accounts)
+            store.close()
+
+            started = time.perf_counter()
+            unpickled(legacy_path, f"user{count - 1}")
+            pickle_time = time.perf_counter() - started
+
+            # Best of a few, the first open after writing can wait on writeback
+            open_time = float("inf")
+            for _ in range(3):
+                started = time.perf_counter()
+                store = AccountStore(os.path.join(directory, "accounts"))
+                open_time = min(open_time, time.perf_counter() - started)
+                store.close()
+            store = AccountStore(os.path.join(directory, "accounts"))
+
+            names = [f"user{number * (count // lookups)}" for number in range(lookups)]
+            started = time.perf_counter()
+            for name in names:
+                store.lookup(name)
+            first_time = (time.perf_counter() - started) / lookups
+            started = time.perf_counter()
+            for name in names:
+                store.lookup(name)
+            cached_time = (time.perf_counter() - started) / lookups
+            store.close()
+
+        print(f"{count:<10}{pickle_time * 1e3:>16.1f}{open_time * 1e3:>15.2f}"
+              f"{first_time * 1e6:>17.1f}{cached_time * 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
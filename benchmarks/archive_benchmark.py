@@ -0,0 +1,54 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from archive import Archive
+
+vocabulary = [f"word{number}" for number in range(5000)]
+
+
+def sentence(generator):
+    # Zipf-like, a few words are everywhere and most are rare
+    return " ".join(vocabulary[min(int(generator.paretovariate(0.8)) - 1, len(vocabulary) - 1)] for _ in range(8))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive append and search cost for one heavy user")
+    parser.add_argument("--messages", type=int, default=200000)
+    given_args = parser.parse_args()
+
+    generator = random.Random(1)
+    with tempfile.TemporaryDirectory() as directory:
+        archive = Archive(directory)
+        started = time.perf_counter()
+        for _ in range(given_args.messages):
+            archive.append("alice", "bob", sentence(generator))
+        elapsed = time.perf_counter() - started
+        print(f"append:          {given_args.messages / elapsed:.0f} messages/s")
+
+        archive.close()
+        started = time.perf_counter()
+        archive = Archive(directory)
+        print(f"open:            {time.perf_counter() - started:.2f}s")
+
+        archive.close()
+        os.unlink(archive.snapshot_path())
+        started = time.perf_counter()
+        archive = Archive(directory)
+        print(f"open, reindexed: {time.perf_counter() - started:.2f}s")
+
+        print(f"{'query':<24}{'matches':>9}{'ms/page':>9}")
+        for query in ("word4000", "word300", "word40", "word3", "word0", "word0 word40", "word1 word2 word3"):
+            started = time.perf_counter()
+            _, total = archive.search("alice", query, 0, 20)
+            print(f"{query:<24}{total:>9}{(time.perf_counter() - started) * 1e3:>9.2f}")
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
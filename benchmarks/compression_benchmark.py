@@ -0,0 +1,70 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from server import fernet
+from transport import FrameCodec
+
+words = "hey hi hello how are you doing fine thanks see you later what time is it lol ok".split()
+
+
+def chat_traffic(frames, seed=1):
+    """Frames a busy connection sends and receives, in wire order."""
+    generator = random.Random(seed)
+    credentials = {"username": "alice", "password": "correct horse"}
+    traffic = []
+
+    for request_id in range(1, frames + 1):
+        message = " ".join(generator.choice(words) for _ in range(generator.randint(1, 12)))
+        kind = generator.random()
+        if kind < 0.45:
+            traffic.append({"command": "message", **credentials, "message": message, "ID": request_id})
+        elif kind < 0.9:
+            traffic.append({"command": "message", "username": "bob", "message": message})
+        elif kind < 0.95:
+            traffic.append({"status": "success", "ID": request_id})
+        else:
+            users = [f"user{generator.randint(1, 500)}" for _ in range(20)]
+            traffic.append({"status": "success", "users": users, "ID": request_id})
+    return traffic
+
+
+def measure(traffic, compression):
+    encoder = FrameCodec(fernet)
+    decoder = FrameCodec(fernet)
+    if compression:
+        encoder.enable_compression()
+        decoder.enable_compression()
+
+    started = time.process_time()
+    frames = [encoder.encode(data) for data in traffic]
+    encoded = time.process_time()
+    for frame in frames:
+        decoder.decode(frame)
+    decoded = time.process_time()
+
+    return sum(len(frame) for frame in frames), encoded - started, decoded - encoded
+
+
+def main(frames=20000):
+    traffic = chat_traffic(frames)
+
+    print(f"{'':<13}{'bytes/frame':>12}{'encode us':>11}{'decode us':>11}")
+    results = {}
+    for name, compression in (("plain", False), ("compressed", True)):
+        size, encode_time, decode_time = measure(traffic, compression)
+        results[name] = (size, encode_time + decode_time)
+        print(f"{name:<13}{size / frames:>12.1f}{encode_time / frames * 1e6:>11.1f}"
+              f"{decode_time / frames * 1e6:>11.1f}")
+
+    plain_size, plain_time = results["plain"]
+    compressed_size, compressed_time = results["compressed"]
+    print(f"bytes saved: {1 - compressed_size / plain_size:.1%}, "
+          f"extra cpu: {(compressed_time - plain_time) / frames * 1e6:.1f}us per frame")
+
+
+if __name__ == "__main__":
+    main()
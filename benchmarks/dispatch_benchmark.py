@@ -0,0 +1,50 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from server import ClientContext, TimerWheel, UserData, UserDataManager, command_dispatcher
+
+
+class DiscardingConnection:
+    def send(self, data):
+        pass
+
+    def send_payload(self, payload, data=None):
+        pass
+
+    def send_response(self, request_id, payload, data=None):
+        pass
+
+
+credentials = {"username": "alice", "password": "secret"}
+
+requests = {
+    "login": {"command": "login", "ID": 1, **credentials},
+    "register": {"command": "register", "ID": 1, **credentials},
+    "advertise": {"command": "advertise", "ID": 1, **credentials},
+    "connect": {"command": "connect", "ID": 1, "target": "bob", **credentials},
+    "message": {"command": "message", "ID": 1, "message": "hello", **credentials},
+    "resume": {"command": "resume", "ID": 1, "token": "token"},
+    "unknown": {"command": "unknown", "ID": 1},
+    "malformed": {"command": "message", "ID": 1, **credentials},
+}
+
+
+def main(iterations=200000):
+    connection = DiscardingConnection()
+    user_data = UserData(connection, "127.0.0.1", 0)
+    # The auth manager is only stored by the commands, preparing them never touches it
+    context = ClientContext(connection, user_data, None, UserDataManager(), TimerWheel())
+
+    print(f"{'request':<12}{'ns/dispatch':>14}")
+    for name, data in requests.items():
+        seconds = timeit.timeit(
+            lambda: command_dispatcher.prepare(data, context), number=iterations
+        )
+        print(f"{name:<12}{seconds / iterations * 1e9:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from server import UserData, UserDataManager
+
+
+def rebuilt(user_data_manager, caller):
+    """What advertise did before the snapshot: filter and serialise the whole list every call."""
+    available_users = [
+        user.display_name
+        for user in user_data_manager.get_users()
+        if user.display_name != caller.display_name
+    ]
+    return json.dumps({"status": "success", "users": available_users, "ID": 1}).encode()
+
+
+def cached(user_data_manager, caller):
+    users = user_data_manager.presence_snapshot().excluding(caller.display_name)
+    return b'{"status": "success", "users": [' + users + b'], "ID": ' + json.dumps(1).encode() + b"}"
+
+
+def main(iterations=2000):
+    print(f"{'online':<9}{'rebuilt us':>12}{'cached us':>12}")
+    for online in (10, 100, 1000, 10000):
+        user_data_manager = UserDataManager()
+        for number in range(online):
+            user_data = UserData(None, "127.0.0.1", 0)
+            user_data.display_name = f"user{number}"
+            user_data_manager.add_user_data(user_data)
+        caller = user_data_manager.get_users()[online // 2]
+        assert json.loads(rebuilt(user_data_manager, caller)) == json.loads(cached(user_data_manager, caller))
+
+        timings = [
+            timeit.timeit(lambda: encode(user_data_manager, caller), number=iterations) / iterations
+            for encode in (rebuilt, cached)
+        ]
+        print(f"{online:<9}{timings[0] * 1e6:>12.1f}{timings[1] * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from accounts import AccountStore, Credentials
+from server import AccountWriter
+
+
+class SynchronousWriter:
+    """The old approach made durable: every registration rewrites and fsyncs the whole file."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.accounts = {}
+        self.lock = threading.Lock()
+        self.commits = 0
+
+    def create_user(self, credentials):
+        with self.lock:
+            self.accounts[credentials.username] = credentials
+            with open(self.file_path, "wb") as file:
+                pickle.dump(self.accounts, file)
+                file.flush()
+                os.fsync(file.fileno())
+            self.commits += 1
+        return True
+
+    def stop(self):
+        pass
+
+
+def run(writer, threads, registrations):
+    def register(thread_number):
+        for number in range(registrations):
+            writer.create_user(Credentials(f"user{thread_number}-{number}", "password"))
+
+    workers = [threading.Thread(target=register, args=(number,)) for number in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    writer.stop()
+    return threads * registrations / elapsed, writer.commits
+
+
+def main(registrations=50):
+    print(f"{'threads':<9}{'sync reg/s':>12}{'fsyncs':>8}{'group reg/s':>13}{'fsyncs':>8}")
+    for threads in (1, 8, 32, 128):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "user_data.pkl")
+            sync_rate, sync_commits = run(SynchronousWriter(path), threads, registrations)
+            os.unlink(path)
+            store = AccountStore(os.path.join(directory, "accounts"))
+            group_rate, group_commits = run(AccountWriter(store), threads, registrations)
+            store.close()
+        print(f"{threads:<9}{sync_rate:>12.0f}{sync_commits:>8}{group_rate:>13.0f}{group_commits:>8}")
+
+
+if __name__ == "__main__":
+    main()
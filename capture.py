@@ -0,0 +1,84 @@
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+
+capture_magic = b"CHATCAP\x01"
+
+# session id, direction, seconds since the capture started, payload length
+record_header = struct.Struct("<IBdI")
+
+inbound = 0
+outbound = 1
+
+
+class CaptureWriter:
+    """Appends decrypted frames from every connection to one binary log.
+
+    The log holds credentials in the clear, so it is only readable by its owner.
+    """
+
+    def __init__(self, path):
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.file = os.fdopen(descriptor, "wb")
+        self.file.write(capture_magic)
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.session_ids = itertools.count(1)
+
+    def new_session(self):
+        return CaptureSession(self, next(self.session_ids))
+
+    def record(self, session_id, direction, data):
+        payload = json.dumps(data, separators=(",", ":")).encode()
+        header = record_header.pack(
+            session_id, direction, time.perf_counter() - self.started, len(payload)
+        )
+        with self.lock:
+            # Sessions still draining while the server stops are dropped
+            if not self.file.closed:
+                self.file.write(header + payload)
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class CaptureSession:
+    def __init__(self, writer, session_id):
+        self.writer = writer
+        self.session_id = session_id
+
+    def inbound(self, data):
+        self.writer.record(self.session_id, inbound, data)
+
+    def outbound(self, data):
+        self.writer.record(self.session_id, outbound, data)
+
+    def close(self):
+        self.writer.flush()
+
+
+def read_capture(path):
+    """Yields (session id, direction, timestamp, data) for every captured frame."""
+    with open(path, "rb") as file:
+        if file.read(len(capture_magic)) != capture_magic:
+            raise ValueError(f"{path} is not a capture file")
+
+        while True:
+            header = file.read(record_header.size)
+            if len(header) < record_header.size:
+                return
+            session_id, direction, timestamp, length = record_header.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length:
+                # Capture was cut off mid-record
+                return
+            yield session_id, direction, timestamp, json.loads(payload)
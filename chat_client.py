@@ -0,0 +1,487 @@
+import itertools
+import selectors
+import socket
+import threading
+import time
+
+from cryptography.fernet import Fernet
+
+from transport import FrameCodec, TcpTransport, frame_delimiter
+
+# Fixed key for encryption and decryption (example key)
+fixed_key = b'koI8rShEVjpTE94K02fghg2gFhctxTalSTmzOzgIB9Y='  # Replace this with your own secret key
+
+# Create a Fernet instance with the fixed key
+fernet = Fernet(fixed_key)
+
+
+def print_message(response):
+    print(f"{response['username']}: {response['message']}")
+
+
+class UserData:
+    def __init__(self):
+        self.username = None
+        self.password = None
+        self.is_logged_in = False
+        self.resume_token = None
+    
+    def store_credentials(self, username, password):
+        self.username = username
+        self.password = password
+        self.is_logged_in = True
+
+class ClientController:
+    resume_attempts = 5
+    resume_delay = 1
+
+    def __init__(self, client, listener=None, on_message=print_message):
+        self.client = client
+        self.listener = listener or ThreadedListener()
+        self.on_message = on_message
+        self.request_helper = self.create_request_helper()
+
+        self.user_data = UserData()
+
+    def create_request_helper(self):
+        return RequestHelper(self.client, self.listener, self.connection_lost, self.on_message)
+
+    def record_credentials(self, username, password):
+        self.user_data.store_credentials(username, password)
+
+    def stop(self):
+        self.request_helper.stop()
+        self.client.close()
+
+    def close(self):
+        """Ends the session for good, the server does not keep it around for resuming."""
+        # Stopped first, the server hanging up in answer is not a lost connection
+        self.request_helper.stop()
+        self.client.send({"command": "close"})
+        self.client.close()
+
+    def start(self):
+        self.user_data = UserData()
+        self.client.start()
+        self.request_helper = self.create_request_helper()
+
+    def connection_lost(self):
+        if self.user_data.resume_token is None:
+            return
+
+        print("Connection lost, resuming session...")
+        for attempt in range(self.resume_attempts):
+            try:
+                response = self.resume()
+            except OSError:
+                time.sleep(self.resume_delay)
+                continue
+
+            if response["status"] == "success":
+                print(f"Session resumed as [{response['username']}]")
+            else:
+                print(response["message"])
+            return
+        print("Could not reach the server")
+
+    def resume(self):
+        previous = self.request_helper
+        previous.stop()
+        self.client.start()
+        self.request_helper = self.create_request_helper()
+        # IDs carry on, so requests retried over the new connection are answered from the server's cache
+        self.request_helper.ids = previous.ids
+        self.request_helper.event_pool = previous.event_pool
+
+        data = {"command": "resume", "token": self.user_data.resume_token}
+        response = self.request_helper.request(data)
+        self.user_data.resume_token = response.get("resume_token")
+        return response
+
+    def request(self, data, callback=None):
+        """Blocks for the response, or hands it to callback on the listener thread."""
+        if callback is None:
+            return self.request_helper.request(data)
+        self.request_helper.request_async(data, callback)
+
+    def login(self, username, password, callback=None):
+        data = {"command": "login", "username": username, "password": password}
+
+        def logged_in(response):
+            if response["status"] == "success":
+                self.user_data.store_credentials(username, password)
+                self.user_data.resume_token = response["resume_token"]
+            if callback is not None:
+                callback(response)
+
+        if callback is not None:
+            return self.request(data, logged_in)
+        response = self.request(data)
+        logged_in(response)
+        return response
+
+    def register(self, username, password, callback=None):
+        data = {"command": "register", "username": username, "password": password}
+        return self.request(data, callback)
+
+    def advertise(self, callback=None):
+        data = {
+            "command": "advertise",
+            "username": self.user_data.username,
+            "password": self.user_data.password,
+        }
+        return self.request(data, callback)
+
+    def search(self, prefix, after=None, limit=20, callback=None):
+        data = {
+            "command": "search",
+            "username": self.user_data.username,
+            "password": self.user_data.password,
+            "prefix": prefix,
+            "after": after,
+            "limit": limit,
+        }
+        return self.request(data, callback)
+
+    def history(self, query, offset=0, limit=20, callback=None):
+        data = {
+            "command": "history",
+            "username": self.user_data.username,
+            "password": self.user_data.password,
+            "query": query,
+            "offset": offset,
+            "limit": limit,
+        }
+        return self.request(data, callback)
+
+    def connect(self, username, callback=None):
+        data = {
+            "command": "connect",
+            "username": self.user_data.username,
+            "password": self.user_data.password,
+            "target": username,
+        }
+        return self.request(data, callback)
+
+    def match(self, criteria=None, callback=None):
+        """Asks to be paired with anyone sharing the criteria, answered whenever a partner turns up."""
+        data = {
+            "command": "match",
+            "username": self.user_data.username,
+            "password": self.user_data.password,
+            "criteria": criteria,
+        }
+        return self.request(data, callback)
+
+    def unmatch(self, callback=None):
+        data = {
+            "command": "unmatch",
+            "username": self.user_data.username,
+            "password": self.user_data.password,
+        }
+        return self.request(data, callback)
+
+    def send(self, message, callback=None):
+        data = {
+            "command": "message",
+            "username": self.user_data.username,
+            "password": self.user_data.password,
+            "message": message,
+        }
+        return self.request(data, callback)
+
+    def quit(self, callback=None):
+        data = {
+            "command": "message",
+            "username": self.user_data.username,
+            "password": self.user_data.password,
+            "message": "",
+            "quit": True
+        }
+        return self.request(data, callback)
+
+
+class RequestHelper():
+    timeout = 60
+    # Times a request is sent again with the same ID after waiting timeout
+    # seconds, the server answers a repeat from its cache without running it twice
+    retries = 0
+
+    def __init__(self, client, listener, on_connection_lost=None, on_message=print_message):
+        self.client = client
+        self.listener = listener
+        self.on_connection_lost = on_connection_lost
+        self.on_message = on_message
+        self.event_pool = {}
+        self.ids = itertools.count(1)
+
+        self.stop_event = threading.Event()
+        self.start()
+
+    def request(self, data):
+        request_id = next(self.ids)
+        data["ID"] = request_id
+
+        # Registered before sending so a fast response is never missed
+        event = threading.Event()
+        self.event_pool[request_id] = event
+        for attempt in range(self.retries + 1):
+            self.client.send(data)
+            flag = event.wait(self.timeout)
+            if flag:
+                break
+        # A late response finds nothing waiting and is dropped
+        self.event_pool.pop(request_id, None)
+
+        if flag:
+            return event.response
+        else:
+            return {"status": "failure", "message": "Request timed out"}
+
+    def request_async(self, data, callback):
+        request_id = next(self.ids)
+        data["ID"] = request_id
+
+        self.event_pool[request_id] = callback
+        self.client.send(data)
+
+    def handle_response(self, response):
+        waiting = self.event_pool.pop(response.get("ID"), None)
+
+        if isinstance(waiting, threading.Event):
+            waiting.response = response
+            waiting.set()
+        elif callable(waiting):
+            waiting(response)
+        elif response.get("command") == "busy":
+            print(response["message"])
+        elif response.get("command") == "ping":
+            self.client.send({"command": "pong"})
+        elif response.get("command") == "message":
+            self.on_message(response)
+        else:
+            print(response)
+
+    def disconnected(self):
+        if not self.stop_event.is_set() and self.on_connection_lost:
+            threading.Thread(target=self.on_connection_lost).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.listener.forget(self)
+
+    def start(self):
+        self.stop_event.clear()
+        self.listener.watch(self)
+
+
+class ThreadedListener:
+    """A reader thread per connection, what the interactive client uses."""
+
+    def watch(self, request_helper):
+        threading.Thread(target=self.listen, args=(request_helper,)).start()
+
+    def forget(self, request_helper):
+        pass
+
+    def listen(self, request_helper):
+        while not request_helper.stop_event.is_set():
+            response = request_helper.client.receive()
+
+            if len(response) == 0:
+                request_helper.disconnected()
+                break
+            request_helper.handle_response(response)
+
+
+class SelectorListener:
+    """Reads every pooled connection from a single thread.
+
+    Callbacks run on that thread, so they must not block on another request.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+        # Lets watch and forget interrupt a select that is already running
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, None)
+
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def wakeup(self):
+        try:
+            self.wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def watch(self, request_helper):
+        with self.lock:
+            self.selector.register(request_helper.client.client_socket, selectors.EVENT_READ, request_helper)
+        self.wakeup()
+
+    def forget(self, request_helper):
+        with self.lock:
+            try:
+                self.selector.unregister(request_helper.client.client_socket)
+            except (KeyError, ValueError):
+                return
+        self.wakeup()
+
+    def listen(self):
+        while not self.stop_event.is_set():
+            for key, events in self.selector.select():
+                request_helper = key.data
+                if request_helper is None:
+                    self.wakeup_receiver.recv(4096)
+                    continue
+
+                responses = request_helper.client.receive_available()
+                if responses is None:
+                    self.forget(request_helper)
+                    request_helper.disconnected()
+                    continue
+                for response in responses:
+                    request_helper.handle_response(response)
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup()
+
+
+class ClientPool:
+    """Many logged-in sessions in one process, all served by one listener thread."""
+
+    def __init__(self, host, port, transport=None):
+        self.host = host
+        self.port = port
+        self.transport = transport
+        self.listener = SelectorListener()
+        self.controllers = []
+
+    def open(self, on_message=print_message):
+        client = Client(self.host, self.port, self.transport)
+        client.start()
+        controller = ClientController(client, self.listener, on_message)
+        self.controllers.append(controller)
+        return controller
+
+    def release(self, controller, close=False):
+        """Drops one session from the pool, close ends it on the server too instead of leaving it resumable."""
+        if close:
+            controller.close()
+        else:
+            controller.stop()
+        self.controllers.remove(controller)
+
+    def close(self):
+        for controller in self.controllers:
+            controller.stop()
+        self.controllers = []
+        self.listener.stop()
+
+
+class Client:
+    buffer_size = 2048
+    compression = True
+    no_delay = True
+    # None keeps the operating system's default socket buffer sizes
+    send_buffer_size = None
+    receive_buffer_size = None
+
+    def __init__(self, host, port, transport=None):
+        self.host = host
+        self.port = port
+        self.transport = transport or TcpTransport(
+            self.no_delay, self.send_buffer_size, self.receive_buffer_size
+        )
+        self.send_lock = threading.Lock()
+
+    def start(self):
+        self.buffer = b""
+        self.frames = []
+        self.codec = FrameCodec(fernet)
+
+        # Connect the socket to the server
+        self.client_socket = self.transport.connect(self.host, self.port)
+        print(f"Client started on {self.host}:{self.port}...")
+
+        if self.compression:
+            self.negotiate()
+
+    def negotiate(self):
+        self.client_socket.sendall(self.process_before_sending({"command": "hello", "compression": ["zlib"]}))
+
+        # Nothing else may be sent until the answer arrives, the server switches
+        # its inbound stream over as soon as it reads the hello
+        while True:
+            while not self.frames:
+                if not self.read_frames():
+                    return
+            response = self.process_received(self.frames[0])
+
+            if response.get("command") == "hello":
+                self.frames.pop(0)
+                if response.get("compression") == "zlib":
+                    self.codec.enable_compression()
+                return
+            elif response.get("command") == "ping":
+                self.frames.pop(0)
+            else:
+                # A busy rejection or a server without negotiation, leave it for the listener
+                return
+
+    def process_before_sending(self, data):
+        return self.codec.encode(data)
+
+    def process_received(self, data):
+        return self.codec.decode(data)
+
+    def send(self, data):
+        try:
+            # The listener thread answers heartbeats while views send requests,
+            # and the compressed stream must be encoded in wire order
+            with self.send_lock:
+                self.client_socket.sendall(self.process_before_sending(data))
+        except socket.error as e:
+            print(f"Socket error: {str(e)}")
+        except Exception as e:
+            print(f"Other exception: {str(e)}")
+    
+    def read_frames(self):
+        try:
+            response_data = self.client_socket.recv(self.buffer_size)
+        except OSError:
+            return False
+        if not response_data:
+            return False
+        self.buffer += response_data
+        *frames, self.buffer = self.buffer.split(frame_delimiter)
+        self.frames.extend(frames)
+        return True
+
+    def receive(self):
+        while not self.frames:
+            if not self.read_frames():
+                return {}
+        return self.process_received(self.frames.pop(0))
+
+    def receive_available(self):
+        """Reads once from a readable socket, returns None once the connection is gone."""
+        if not self.read_frames():
+            return None
+        responses = [self.process_received(frame) for frame in self.frames]
+        self.frames = []
+        return responses
+
+    def close(self):
+        print("Closing connection to the server")
+        try:
+            # Closing alone does not wake the listener thread blocked in recv
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.client_socket.close()
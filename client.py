@@ -1,29 +1,9 @@
-from collections import OrderedDict
-import socket
-import sys
 import argparse
-import json
 import threading
+from collections import OrderedDict
 
-from cryptography.fernet import Fernet
-
-# Fixed key for encryption and decryption (example key)
-fixed_key = b'koI8rShEVjpTE94K02fghg2gFhctxTalSTmzOzgIB9Y='  # Replace this with your own secret key
-
-# Create a Fernet instance with the fixed key
-fernet = Fernet(fixed_key)
-
-# Function to encrypt a message
-def encrypt_message(message):
-    encrypted_message = fernet.encrypt(message.encode())
-    return encrypted_message
-
-# Function to decrypt an encrypted message
-def decrypt_message(encrypted_message):
-    decrypted_message = fernet.decrypt(encrypted_message).decode()
-    return decrypted_message
-
-from client_server import ContextSwitcher as ClientServerContextSwitcher
+from chat_client import Client, ClientController, RequestHelper
+from config import Configuration, Setting, flag, integer, number, optional, text
 
 class LoginView:
     def __init__(self, client_controller):
@@ -33,11 +13,9 @@ class LoginView:
         username = input("username: ")
         password = input("password: ")
 
-        response = client_controller.login(username, password)
+        response = self.client_controller.login(username, password)
 
-        if response["status"] == "success":
-            client_controller.record_credentials(username, password)
-        elif response["status"] == "failure":
+        if response["status"] == "failure":
             print(response["message"])
 
 
@@ -49,7 +27,7 @@ class RegisterView:
         username = input("username: ")
         password = input("password: ")
 
-        response = client_controller.register(username, password)
+        response = self.client_controller.register(username, password)
 
         if response["status"] == "success":
             print("Successfully registered user")
@@ -58,30 +36,41 @@ class RegisterView:
 
 
 class ChatView:
+    page_size = 20
+
     def __init__(self, client_controller, view_manager):
         self.client_controller = client_controller
         self.view_manager = view_manager
 
     def activate(self):
-        response = client_controller.advertise()
+        prefix = input("Search users (leave empty to browse everyone): ")
+        after = None
 
-        if response["status"] == "success":
-            options = ChatOptions(client_controller, self.view_manager, response["users"])
+        while self.view_manager.active:
+            response = self.client_controller.search(prefix, after, self.page_size)
+
+            if response["status"] == "failure":
+                print(response["message"])
+                return
 
-            if len(options.get_options()) == 0:
-                print("No users online\nTry Again?")
+            users = response["users"]
+            if len(users) == 0:
+                print("No users found\nTry Again?")
                 selected = int(input("[0] Yes\n[1] No\n>"))
                 if selected == 0:
                     self.activate()
-            else:
-                while self.view_manager.active:
-                    print("Select a user to chat with:")
-                    options.display()
-                    selected = int(input(">"))
-                    options.select_option(selected)
-        elif response["status"] == "failure":
-            print(response["message"])
+                return
+
+            options = ChatOptions(self.client_controller, self.view_manager, users)
+            if response["more"]:
+                options.add_option("Next page", lambda: users[-1])
 
+            print("Select a user to chat with:")
+            options.display()
+            selected = int(input(">"))
+            next_page = options.select_option(selected)
+            if next_page is not None:
+                after = next_page
 
 class HomeView:
     def __init__(self, client_controller, view_manager):
@@ -91,8 +80,8 @@ class HomeView:
 
     def activate(self):
         while self.view_manager.active:
-            if client_controller.user_data.is_logged_in:
-                print(f"Logged in as [{client_controller.user_data.username}]")
+            if self.client_controller.user_data.is_logged_in:
+                print(f"Logged in as [{self.client_controller.user_data.username}]")
 
             print("Select an action:")
             self.options.display()
@@ -100,18 +89,78 @@ class HomeView:
             self.options.select_option(selected)
             self.view_manager.reset()
 
+
+class MatchView:
+    def __init__(self, client_controller, view_manager):
+        self.client_controller = client_controller
+        self.view_manager = view_manager
+
+    def activate(self):
+        topic = input("Topic to match on (leave empty for anyone): ").strip()
+        matched = threading.Event()
+
+        def on_match(response):
+            matched.response = response
+            matched.set()
+            if response["status"] == "success":
+                print(f"Matched with {response['partner']}, press enter to start chatting")
+            else:
+                print(response["message"])
+
+        # Answered on the listener thread, nothing polls while we wait
+        self.client_controller.match({"topic": topic} if topic else None, on_match)
+        print("Waiting for a partner, press enter to stop waiting")
+        input("")
+        if not matched.is_set():
+            self.client_controller.unmatch()
+            matched.wait(1)
+        if matched.is_set() and matched.response["status"] == "success":
+            MessageView(self.client_controller, self.view_manager).activate()
+
+
+class HistoryView:
+    page_size = 10
+
+    def __init__(self, client_controller):
+        self.client_controller = client_controller
+
+    def activate(self):
+        query = input("Search your messages for: ")
+        offset = 0
+
+        while True:
+            response = self.client_controller.history(query, offset, self.page_size)
+
+            if response["status"] == "failure":
+                print(response["message"])
+                return
+            if response["total"] == 0:
+                print("No messages found")
+                return
+
+            for message in response["messages"]:
+                print(f"{message['from']} -> {message['to']}: {message['message']}")
+            if not response["more"]:
+                return
+
+            offset += len(response["messages"])
+            selected = int(input(f"[0] More ({response['total'] - offset} left)\n[1] Done\n>"))
+            if selected != 0:
+                return
+
+
 class MessageView:
     def __init__(self, client_controller, view_manager):
         self.client_controller = client_controller
         self.view_manager = view_manager
     
     def activate(self):
-        while view_manager.active:
+        while self.view_manager.active:
             message = input("")
-            print(f"{client_controller.user_data.username}: {message}")
-            response = client_controller.send(message)
+            print(f"{self.client_controller.user_data.username}: {message}")
+            response = self.client_controller.send(message)
             if response["status"] == "failure":
-                view_manager.restart()
+                self.view_manager.restart()
 
 
 class Options:
@@ -135,8 +184,6 @@ class Options:
 
 
 class HomeOptions(Options):
-    options = OrderedDict()
-
     def login(self):
         LoginView(self.client_controller).activate()
 
@@ -146,21 +193,30 @@ class HomeOptions(Options):
     def chat(self):
         ChatView(self.client_controller, self.view_manager).activate()
 
+    def match(self):
+        MatchView(self.client_controller, self.view_manager).activate()
+
+    def history(self):
+        HistoryView(self.client_controller).activate()
+
     def __init__(self, client_controller, view_manager):
         self.client_controller = client_controller
         self.view_manager = view_manager
+        self.options = OrderedDict()
 
         self.add_option("Login", self.login)
         self.add_option("Register", self.register)
         self.add_option("Chat", self.chat)
+        self.add_option("Chat with anyone", self.match)
+        self.add_option("Search messages", self.history)
 
 
 class ChatOptions(Options):
-    options = OrderedDict()
-
     def __init__(self, client_controller, view_manager, users):
+        # One set of options per page of results
+        self.options = OrderedDict()
         for user in users:
-            def connect():
+            def connect(user=user):
                 response = client_controller.connect(user)
                 if response["status"] == "success":
                     print(f"Connected to {user}")
@@ -188,6 +244,9 @@ class ContextSwitcher:
         self.port = response.get("port")
 
     def switch_context(self):
+        # Imported here so headless users of this module don't need the peer module
+        from client_server import ContextSwitcher as ClientServerContextSwitcher
+
         self.client_controller.stop()
         ClientServerContextSwitcher(self.address, self.port, self.username, self.is_client)
         self.view_manager.restart()
@@ -195,174 +254,12 @@ class ContextSwitcher:
 
     def connect(self):
         print(f"Connecting to {self.user}...")
-        response = client_controller.connect(self.user)
+        response = self.client_controller.connect(self.user)
         if response["status"] == "success":
             print(f"Connected to {self.user}")
             self.extract_data(response)
             self.switch_context()
 
-class UserData:
-    def __init__(self):
-        self.username = None
-        self.password = None
-        self.is_logged_in = False
-    
-    def store_credentials(self, username, password):
-        self.username = username
-        self.password = password
-        self.is_logged_in = True
-
-class ClientController:
-    def __init__(self, client):
-        self.client = client
-        self.request_helper = RequestHelper(client)
-
-        self.user_data = UserData()
-
-    def record_credentials(self, username, password):
-        self.user_data.store_credentials(username, password)
-
-    def stop(self):
-        self.request_helper.stop()
-        self.client.close()
-
-    def start(self):
-        self.user_data = UserData()
-        self.client.start()
-        self.request_helper = RequestHelper(client)
-
-    def login(self, username, password):
-        data = {"command": "login", "username": username, "password": password}
-        return self.request_helper.request(data)
-
-    def register(self, username, password):
-        data = {"command": "register", "username": username, "password": password}
-        return self.request_helper.request(data)
-
-    def advertise(self):
-        data = {
-            "command": "advertise",
-            "username": self.user_data.username,
-            "password": self.user_data.password,
-        }
-        return self.request_helper.request(data)
-
-    def connect(self, username):
-        data = {
-            "command": "connect",
-            "username": self.user_data.username,
-            "password": self.user_data.password,
-            "target": username,
-        }
-        return self.request_helper.request(data)
-    
-    def send(self, message):
-        data = {
-            "command": "message",
-            "username": self.user_data.username,
-            "password": self.user_data.password,
-            "message": message,
-        }
-        return self.request_helper.request(data)
-    
-    def quit(self):
-        data = {
-            "command": "message",
-            "username": self.user_data.username,
-            "password": self.user_data.password,
-            "message": "",
-            "quit": True
-        }
-        return self.request_helper.request(data)
-
-class RequestHelper():
-    timeout = 60
-    id = 0
-
-    def __init__(self, client):
-        self.client = client
-        self.event_pool = {}
-
-        self.stop_event = threading.Event()
-        self.start()
-
-    def request(self, data):
-        self.id += 1
-        data["ID"] = self.id
-        self.client.send(data)
-
-        self.event_pool[self.id] = threading.Event()
-        flag = self.event_pool[self.id].wait(self.timeout)
-
-        if flag:
-            return self.event_pool[self.id]
-        else:
-            return {"status": "failure", "message": "Request timed out"}
-    
-    def listen(self):
-        while not self.stop_event.is_set():
-            response = self.client.receive()
-
-            if len(response) == 0:
-                break
-
-            if response.get("ID") in self.event_pool:
-                event = self.event_pool[response["ID"]]
-
-                self.event_pool[response["ID"]] = response
-
-                event.set()
-            elif response.get("command") == "message":
-                print(f"{response['username']}: {response['message']}")
-            else:
-                print(response)
-
-    def stop(self):
-        self.stop_event.set()
-
-    def start(self):
-        self.stop_event.clear()
-        threading.Thread(target=self.listen).start()
-    
-
-class Client:
-    buffer_size = 2048
-
-    def __init__(self, host, port):
-        self.host = host
-        self.port = port
-
-    def start(self):
-        # Create a TCP/IP socket
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        # Connect the socket to the server
-        self.client_socket.connect((self.host, self.port))
-        print(f"Client started on {self.host}:{self.port}...")
-
-    def process_before_sending(self, data):
-        return encrypt_message(json.dumps(data))
-
-    def process_received(self, data):
-        return json.loads(decrypt_message(data))
-
-    def send(self, data):
-        try:
-            self.client_socket.sendall(self.process_before_sending(data))
-        except socket.error as e:
-            print(f"Socket error: {str(e)}")
-        except Exception as e:
-            print(f"Other exception: {str(e)}")
-    
-    def receive(self):
-        response_data = self.client_socket.recv(self.buffer_size)
-        return self.process_received(response_data)
-
-    def close(self):
-        print("Closing connection to the server")
-        self.client_socket.close()
-
 class ViewManager:
     def __init__(self):
         self.active = True
@@ -376,8 +273,35 @@ class ViewManager:
         if self.reset_flag:
             self.active = True
 
+def client_settings():
+    return [
+        Setting("host", None, None, text, "server address"),
+        Setting("port", None, None, integer, "server port"),
+        Setting("buffer_size", Client, "buffer_size", integer, "bytes read from the socket per recv"),
+        Setting("send_buffer_size", Client, "send_buffer_size", optional(integer), "SO_SNDBUF of the socket"),
+        Setting("receive_buffer_size", Client, "receive_buffer_size", optional(integer), "SO_RCVBUF of the socket"),
+        Setting("no_delay", Client, "no_delay", flag, "disable Nagle's algorithm"),
+        Setting("compression", Client, "compression", flag, "ask the server for zlib compression"),
+        Setting("request_timeout", RequestHelper, "timeout", number, "seconds to wait for a response"),
+        Setting("request_retries", RequestHelper, "retries", integer, "times a request that timed out is sent again"),
+        Setting("resume_attempts", ClientController, "resume_attempts", integer, "reconnects tried after the connection drops"),
+        Setting("resume_delay", ClientController, "resume_delay", number, "seconds between reconnects"),
+    ]
+
+
 if __name__ == "__main__":
-    client = Client("localhost", 20)
+    configuration = Configuration(client_settings(), host="localhost", port=20)
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument("--config", help="JSON file of settings, overridden by CHAT_* variables and flags")
+    configuration.add_arguments(parser)
+    given_args = parser.parse_args()
+    try:
+        configuration.load(given_args, given_args.config)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    configuration.apply()
+
+    client = Client(configuration["host"], configuration["port"])
     client.start()
     
     client_controller = ClientController(client)
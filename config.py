@@ -0,0 +1,142 @@
+import json
+import os
+
+# CHAT_PORT=2020 sets port, and so on for every setting
+environment_prefix = "CHAT_"
+
+
+def integer(value):
+    return int(value)
+
+
+def number(value):
+    return float(value)
+
+
+def text(value):
+    return str(value)
+
+
+def flag(value):
+    if isinstance(value, bool):
+        return value
+    lowered = str(value).strip().lower()
+    if lowered in ("1", "true", "yes", "on"):
+        return True
+    if lowered in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(f"expected true or false, got {value!r}")
+
+
+def optional(kind):
+    """None, "none" or "default" keep the built-in behaviour, anything else is parsed with kind."""
+    def parse(value):
+        if value is None or str(value).strip().lower() in ("none", "default", ""):
+            return None
+        return kind(value)
+    parse.__name__ = f"optional {kind.__name__}"
+    return parse
+
+
+def pair(value):
+    """"20,40" or [20, 40], for (rate, burst) limits."""
+    if isinstance(value, str):
+        value = value.split(",")
+    first, second = value
+    return (float(first), float(second))
+
+
+class Setting:
+    def __init__(self, name, owner, attribute, kind, help):
+        self.name = name
+        # A class or module whose attribute holds the value, None for values
+        # the caller reads itself, like the address to listen on
+        self.owner = owner
+        self.attribute = attribute
+        self.kind = kind
+        self.help = help
+        self.fallback = None
+
+    def default(self):
+        if self.owner is None:
+            return self.fallback
+        return getattr(self.owner, self.attribute)
+
+    def flag_name(self):
+        return "--" + self.name.replace("_", "-")
+
+    def environment_name(self):
+        return environment_prefix + self.name.upper()
+
+
+class Configuration:
+    """Settings from built-in defaults, a JSON file, CHAT_* environment variables and the command line.
+
+    Each source overrides the ones before it, and every value remembers
+    where it came from so the effective configuration can be printed.
+    """
+
+    def __init__(self, settings, **fallbacks):
+        self.settings = {setting.name: setting for setting in settings}
+        for name, value in fallbacks.items():
+            self.settings[name].fallback = value
+        self.values = {name: setting.default() for name, setting in self.settings.items()}
+        self.sources = {name: "default" for name in self.settings}
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def set(self, name, value, source):
+        setting = self.settings[name]
+        try:
+            self.values[name] = setting.kind(value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid value {value!r} for {name} from {source}: {e}")
+        self.sources[name] = source
+
+    def add_arguments(self, parser):
+        for setting in self.settings.values():
+            # Left as None so only flags actually given override the file and environment
+            parser.add_argument(
+                setting.flag_name(), dest=setting.name, default=None, metavar="VALUE",
+                help=f"{setting.help} (default {setting.default()}, or {setting.environment_name()})",
+            )
+
+    def load_file(self, path):
+        with open(path) as file:
+            values = json.load(file)
+        for name, value in values.items():
+            if name not in self.settings:
+                raise ValueError(f"Unknown setting {name!r} in {path}")
+            self.set(name, value, path)
+
+    def load_environment(self, environment=None):
+        environment = os.environ if environment is None else environment
+        for name, setting in self.settings.items():
+            if setting.environment_name() in environment:
+                self.set(name, environment[setting.environment_name()], setting.environment_name())
+
+    def load_arguments(self, arguments):
+        for name in self.settings:
+            value = getattr(arguments, name, None)
+            if value is not None:
+                self.set(name, value, "command line")
+
+    def load(self, arguments, path=None):
+        if path:
+            self.load_file(path)
+        self.load_environment()
+        self.load_arguments(arguments)
+
+    def apply(self):
+        """Sets every value on the class or module it belongs to."""
+        for name, setting in self.settings.items():
+            if setting.owner is not None:
+                setattr(setting.owner, setting.attribute, self.values[name])
+
+    def describe(self):
+        width = max(len(name) for name in self.settings)
+        return [
+            f"{name:<{width}}  {self.values[name]!s:<12}  {self.sources[name]}"
+            for name in self.settings
+        ]
@@ -0,0 +1,153 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+
+class CommandTimings:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def record(self, label, elapsed):
+        self.samples[label].append(elapsed)
+
+    def rows(self):
+        for label, samples in sorted(self.samples.items(), key=lambda item: -sum(item[1])):
+            ordered = sorted(samples)
+            yield (
+                label,
+                len(ordered),
+                sum(ordered),
+                ordered[len(ordered) // 2],
+                ordered[len(ordered) * 99 // 100],
+            )
+
+
+class Profiler:
+    """Samples every busy thread's stack and tracks allocations for a bounded window.
+
+    While inactive the hooks on the hot path cost one attribute check. Threads
+    label themselves with what they are doing, so samples and timings are
+    attributed per command type.
+    """
+
+    sample_interval = 0.005
+    stack_depth = 48
+    allocation_frames = 8
+    top_entries = 40
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.active = False
+        self.lock = threading.Lock()
+        self.labels = {}
+        self.timings = None
+        self.stacks = None
+        self.finished = threading.Event()
+        self.thread = None
+
+    def label(self, name):
+        self.labels[threading.get_ident()] = name
+
+    def unlabel(self):
+        self.labels.pop(threading.get_ident(), None)
+
+    def record(self, label, elapsed):
+        with self.lock:
+            if self.timings is not None:
+                self.timings.record(label, elapsed)
+
+    def start(self, window):
+        with self.lock:
+            if self.active:
+                return False
+            self.timings = CommandTimings()
+            self.stacks = Counter()
+            self.finished.clear()
+            self.active = True
+        tracemalloc.start(self.allocation_frames)
+        self.thread = threading.Thread(target=self.run, args=(window,), daemon=True)
+        self.thread.start()
+        print(f"Profiling for {window}s")
+        return True
+
+    def stop(self):
+        """Ends the window early, the report is still written."""
+        self.finished.set()
+
+    def toggle(self, window):
+        if not self.start(window):
+            self.stop()
+
+    def run(self, window):
+        started = time.perf_counter()
+        deadline = started + window
+        own_thread = threading.get_ident()
+        samples = 0
+
+        while not self.finished.wait(self.sample_interval) and time.perf_counter() < deadline:
+            labels = dict(self.labels)
+            for thread_id, frame in sys._current_frames().items():
+                label = labels.get(thread_id)
+                if label is None or thread_id == own_thread:
+                    # Idle threads only show where they wait
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.stack_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[(label, tuple(stack))] += 1
+            samples += 1
+
+        allocations = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        with self.lock:
+            self.active = False
+            timings, stacks = self.timings, self.stacks
+            self.timings = self.stacks = None
+        path = self.write_report(time.perf_counter() - started, samples, timings, stacks, allocations)
+        print(f"Profile written to {path}")
+
+    def write_report(self, elapsed, samples, timings, stacks, allocations):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.directory, f"profile-{stamp}.txt")
+
+        # Folded stacks, one per line, for flame graph tools
+        with open(os.path.join(self.directory, f"profile-{stamp}.folded"), "w") as file:
+            for (label, stack), count in stacks.most_common():
+                file.write(f"{label};{';'.join(stack)} {count}\n")
+
+        by_label = Counter()
+        own = defaultdict(Counter)
+        inclusive = defaultdict(Counter)
+        for (label, stack), count in stacks.items():
+            by_label[label] += count
+            own[label][stack[-1]] += count
+            for function in set(stack):
+                inclusive[label][function] += count
+
+        with open(path, "w") as file:
+            file.write(f"window {elapsed:.1f}s, {samples} samples every {self.sample_interval * 1e3:.0f}ms\n\n")
+
+            file.write(f"{'timed':<16}{'count':>9}{'total ms':>11}{'p50 us':>10}{'p99 us':>10}\n")
+            for label, count, total, median, tail in timings.rows():
+                file.write(f"{label:<16}{count:>9}{total * 1e3:>11.1f}{median * 1e6:>10.0f}{tail * 1e6:>10.0f}\n")
+
+            for label, count in by_label.most_common():
+                file.write(f"\n[{label}] {count} samples, {count * self.sample_interval * 1e3:.0f}ms on cpu or blocked\n")
+                file.write("  own time:\n")
+                for function, hits in own[label].most_common(self.top_entries // 2):
+                    file.write(f"  {hits:>7}  {function}\n")
+                file.write("  including callees:\n")
+                for function, hits in inclusive[label].most_common(self.top_entries // 2):
+                    file.write(f"  {hits:>7}  {function}\n")
+
+            file.write("\nallocations still held at the end of the window:\n")
+            for statistic in allocations.statistics("lineno")[: self.top_entries]:
+                file.write(f"  {statistic}\n")
+        return path
@@ -0,0 +1,166 @@
+import argparse
+import threading
+import time
+from collections import defaultdict
+
+from capture import inbound, outbound, read_capture
+from chat_client import Client
+
+
+def load_sessions(path):
+    """Groups a capture into per-session request timelines and captured latencies."""
+    requests = defaultdict(list)
+    received_at = {}
+    latencies = {}
+
+    for session_id, direction, timestamp, data in read_capture(path):
+        if not isinstance(data, dict):
+            continue
+        request_id = data.get("ID")
+        if direction == inbound:
+            requests[session_id].append((timestamp, data))
+            if request_id is not None:
+                received_at[(session_id, request_id)] = (timestamp, data.get("command"))
+        elif direction == outbound and (session_id, request_id) in received_at:
+            key = (session_id, request_id)
+            if key not in latencies:
+                started, command = received_at[key]
+                latencies[key] = (command, timestamp - started)
+
+    return requests, latencies
+
+
+class SessionReplay:
+    # How long to wait for responses after the last request went out
+    drain_timeout = 5
+
+    def __init__(self, host, port, requests, started, speed):
+        self.client = Client(host, port)
+        self.requests = requests
+        self.started = started
+        self.speed = speed
+
+        self.sent_at = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.drained = threading.Event()
+
+    def listen(self):
+        while True:
+            response = self.client.receive()
+            if len(response) == 0:
+                break
+
+            if response.get("command") == "ping":
+                self.client.send({"command": "pong"})
+                continue
+
+            request_id = response.get("ID")
+            with self.lock:
+                if request_id in self.sent_at and request_id not in self.latencies:
+                    self.latencies[request_id] = time.perf_counter() - self.sent_at[request_id]
+                    if len(self.latencies) == len(self.sent_at):
+                        self.drained.set()
+
+    def run(self):
+        self.client.start()
+        listener = threading.Thread(target=self.listen, daemon=True)
+        listener.start()
+
+        for timestamp, data in self.requests:
+            delay = self.started + timestamp / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            command = data.get("command")
+            # The replaying client answers heartbeats and negotiates on its own
+            if command in ("pong", "hello"):
+                continue
+            if "ID" in data:
+                with self.lock:
+                    self.sent_at[data["ID"]] = time.perf_counter()
+            self.client.send(data)
+            if command == "close":
+                break
+
+        with self.lock:
+            if len(self.latencies) == len(self.sent_at):
+                self.drained.set()
+        self.drained.wait(self.drain_timeout)
+        self.client.close()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(sessions, replays, captured_latencies):
+    captured = defaultdict(list)
+    replayed = defaultdict(list)
+    lost = defaultdict(int)
+
+    for session_id, replay in zip(sessions, replays):
+        for request_id in replay.sent_at:
+            key = (session_id, request_id)
+            if key not in captured_latencies:
+                continue
+            command, latency = captured_latencies[key]
+            captured[command].append(latency)
+            if request_id in replay.latencies:
+                replayed[command].append(replay.latencies[request_id])
+            else:
+                lost[command] += 1
+
+    print(f"{'command':<12}{'count':>7}{'captured p50':>15}{'replayed p50':>15}"
+          f"{'captured p99':>15}{'replayed p99':>15}{'lost':>6}")
+    for command in sorted(captured):
+        if not replayed[command]:
+            print(f"{command:<12}{len(captured[command]):>7}{'':>60}{lost[command]:>6}")
+            continue
+        print(
+            f"{command:<12}{len(captured[command]):>7}"
+            f"{percentile(captured[command], 0.5) * 1e3:>13.2f}ms"
+            f"{percentile(replayed[command], 0.5) * 1e3:>13.2f}ms"
+            f"{percentile(captured[command], 0.99) * 1e3:>13.2f}ms"
+            f"{percentile(replayed[command], 0.99) * 1e3:>13.2f}ms"
+            f"{lost[command]:>6}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a capture recorded with server.py --capture")
+    parser.add_argument("capture")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=20)
+    parser.add_argument("--speed", type=float, default=1.0, help="2 replays twice as fast")
+    parser.add_argument("--sessions", type=int, nargs="*", help="only replay these session ids")
+    given_args = parser.parse_args()
+
+    requests, captured_latencies = load_sessions(given_args.capture)
+    sessions = given_args.sessions or sorted(requests)
+    # Sessions keep their offsets relative to each other, not just to themselves
+    first_timestamp = min(requests[session_id][0][0] for session_id in sessions)
+
+    started = time.perf_counter()
+    replays = [
+        SessionReplay(
+            given_args.host,
+            given_args.port,
+            [(timestamp - first_timestamp, data) for timestamp, data in requests[session_id]],
+            started,
+            given_args.speed,
+        )
+        for session_id in sessions
+    ]
+    threads = [threading.Thread(target=replay.run) for replay in replays]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report(sessions, replays, captured_latencies)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,28 @@
 import socket
 import threading
-from threading import Event
 import sys
 import argparse
+import bisect
 import json
+import math
 import os
-import pickle
+import queue
+import secrets
+import selectors
+import signal
+import time
+from collections import OrderedDict, deque
 
 from cryptography.fernet import Fernet
 
+from accounts import AccountStore, Credentials
+from archive import Archive
+from autotune import LoadProbe, suggest
+from capture import CaptureWriter
+from config import Configuration, Setting, flag, integer, number, optional, pair, text
+from profiling import Profiler
+from transport import FrameCodec, TcpTransport, frame_delimiter
+
 # Fixed key for encryption and decryption (example key)
 fixed_key = b'koI8rShEVjpTE94K02fghg2gFhctxTalSTmzOzgIB9Y='   # Replace this with your own secret key
 
@@ -25,70 +39,476 @@ def decrypt_message(encrypted_message):
     decrypted_message = fernet.decrypt(encrypted_message).decode()
     return decrypted_message
 
+class MonotonicClock:
+    def now(self):
+        return time.monotonic()
 
-class Credentials:
-    def __init__(self, username, password):
-        self.username = username
-        self.password = password
 
+# Swapped for a simulated clock by simulation.py
+clock = MonotonicClock()
 
-class CredentialsRepository:
-    file_path = "./user_data.pkl"
+# Lets a heartbeat give up instead of blocking on a client that stopped reading
+send_nowait_flag = getattr(socket, "MSG_DONTWAIT", 0)
+
+# IOV_MAX is at least 1024 wherever sendmsg exists
+max_frames_per_write = 1024
+
+# Connections written to by the command running on this thread, flushed when it ends
+dispatch_cycle = threading.local()
+
+# Control traffic (logins, connects, responses, heartbeats) is always taken
+# before bulk chat traffic, in both directions
+control_lane = 0
+bulk_lane = 1
+lane_names = ("control", "bulk")
+# Bulk frames written between checks for newly queued control frames
+bulk_frames_per_write = 64
+
+
+class LaneMetrics:
+    """Recent queueing delays per lane, before a worker picks a frame up and before it is written."""
+
+    samples_kept = 1024
 
     def __init__(self):
-        self.users_data = self.load_data()
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counts = {}
+
+    def record(self, direction, lane, delay):
+        key = (direction, lane_names[lane])
+        with self.lock:
+            samples = self.samples.get(key)
+            if samples is None:
+                samples = self.samples[key] = deque(maxlen=self.samples_kept)
+            samples.append(delay)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def summary(self):
+        """(direction, lane, frames, p50, p99) for every lane that has seen traffic."""
+        with self.lock:
+            snapshot = {key: sorted(samples) for key, samples in self.samples.items()}
+            counts = dict(self.counts)
+        return [
+            (direction, lane, counts[direction, lane], ordered[len(ordered) // 2], ordered[len(ordered) * 99 // 100])
+            for (direction, lane), ordered in sorted(snapshot.items())
+        ]
+
+
+class WriteBatch:
+    """Holds back every frame written while a command runs so each socket gets one write."""
+
+    def __enter__(self):
+        dispatch_cycle.connections = []
+        return self
+
+    def __exit__(self, *exc_info):
+        connections = dispatch_cycle.connections
+        dispatch_cycle.connections = None
+
+        for connection in connections:
+            try:
+                connection.flush()
+            except OSError:
+                # A dead peer is noticed and cleaned up by its own handler
+                pass
+
+
+class Connection:
+    # Longest frame a client may send in bytes, encrypted and encoded, a
+    # connection buffering more without a delimiter is dropped
+    max_frame_size = 128 * 1024
+    # Bytes queued for a client before it counts as a slow consumer and is cut off
+    max_queued_bytes = 1024 * 1024
+
+    def __init__(self, socket, data_payload):
+        self.socket = socket
+        self.data_payload = data_payload
+        self.buffer = b""
+        self.codec = FrameCodec(fernet)
+        self.send_lock = threading.Lock()
+        # Frames are queued unencoded per lane and encoded when written, so
+        # reordering them never breaks the compressed stream
+        self.queue_lock = threading.Lock()
+        self.lanes = ([], [])
+        self.queued_bytes = 0
+        # Encoded frames the socket did not take yet, written before anything else
+        self.unsent = []
+        self.unsent_bytes = 0
+        # Called when writes wait for the socket, so someone watches it turn writable
+        self.on_blocked = None
+        self.write_watched = False
+        self.dropped = False
+        self.capture = None
+        self.metrics = None
+        self.responses = None
+
+    def encode(self, data):
+        return self.codec.encode(data)
+
+    def send(self, data, lane=control_lane):
+        self.send_payload(json.dumps(data).encode(), data, lane)
+
+    def send_response(self, request_id, payload, data=None):
+        """Sends the answer to a request, kept for a retry of the same request to get again."""
+        if self.responses is not None:
+            self.responses.record(request_id, payload)
+        self.send_payload(payload, data)
+
+    def send_payload(self, payload, data=None, lane=control_lane):
+        """Sends an already serialised message, data is only needed for the capture."""
+        if self.capture is not None:
+            self.capture.outbound(json.loads(payload) if data is None else data)
+        with self.queue_lock:
+            overflow = self.queued_bytes + self.unsent_bytes + len(payload) > self.max_queued_bytes
+            if not overflow:
+                self.lanes[lane].append((payload, time.perf_counter()))
+                self.queued_bytes += len(payload)
+        if overflow:
+            if not self.dropped:
+                self.dropped = True
+                print(f"Dropping a client that is not reading, over {self.max_queued_bytes} bytes queued")
+                self.shutdown()
+            raise OSError("client is not reading")
+
+        connections = getattr(dispatch_cycle, "connections", None)
+        if connections is None:
+            self.flush()
+        elif self not in connections:
+            connections.append(self)
+
+    def has_pending(self):
+        return bool(self.lanes[control_lane] or self.lanes[bulk_lane])
+
+    def take_frames(self):
+        """Encodes the next frames to write, all queued control frames first. Needs the send lock."""
+        with self.queue_lock:
+            control = self.lanes[control_lane][:]
+            del self.lanes[control_lane][:]
+            bulk = self.lanes[bulk_lane][:bulk_frames_per_write]
+            del self.lanes[bulk_lane][:bulk_frames_per_write]
+            self.queued_bytes -= sum(len(payload) for payload, _ in control + bulk)
+
+        frames = []
+        now = time.perf_counter()
+        for lane, queued in ((control_lane, control), (bulk_lane, bulk)):
+            for payload, queued_at in queued:
+                frames.append(self.codec.encode_payload(payload))
+                if self.metrics is not None:
+                    self.metrics.record("outbound", lane, now - queued_at)
+        return frames
+
+    def flush(self):
+        """Writes what the socket takes without waiting, returns False if some is left for later."""
+        with self.send_lock:
+            while True:
+                # Nothing more is encoded while the socket is full, so control
+                # frames queued meanwhile still go ahead of the queued chat
+                if not self.unsent:
+                    self.unsent = self.take_frames()
+                    self.unsent_bytes = sum(len(frame) for frame in self.unsent)
+                    if not self.unsent:
+                        return True
+                if not self.write_unsent():
+                    break
+            notify = not self.write_watched
+            self.write_watched = True
+        if notify and self.on_blocked is not None:
+            self.on_blocked()
+        return False
 
-    def load_data(self):
-        if os.path.exists(self.file_path):
-            with open(self.file_path, "rb") as file:
-                try:
-                    data = pickle.load(file)
-                except (pickle.UnpicklingError, EOFError):
-                    data = {}
-        else:
-            data = {}
-        return data
+    def write_unsent(self):
+        """Returns True once every unsent frame is written. Needs the send lock."""
+        frames = self.unsent
+        try:
+            while frames:
+                if hasattr(self.socket, "sendmsg"):
+                    sent = self.socket.sendmsg(frames[:max_frames_per_write])
+                else:
+                    sent = self.socket.send(frames[0])
+                self.unsent_bytes -= sent
+                written = 0
+                while written < len(frames) and sent >= len(frames[written]):
+                    sent -= len(frames[written])
+                    written += 1
+                frames = frames[written:]
+                if sent:
+                    frames[0] = frames[0][sent:]
+        except (BlockingIOError, InterruptedError):
+            pass
+        finally:
+            self.unsent = frames
+        return not frames
+
+    def watch_writes(self):
+        """Returns whether there is output waiting for the socket, watched until this says no."""
+        with self.send_lock:
+            self.write_watched = bool(self.unsent)
+            return self.write_watched
+
+    def try_send(self, data):
+        if not self.send_lock.acquire(blocking=False):
+            return False
+        try:
+            if self.unsent or self.has_pending():
+                # A flush is on its way, the connection is not idle
+                return True
+            frame = self.encode(data)
+            sent = self.socket.send(frame, send_nowait_flag)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        finally:
+            self.send_lock.release()
+
+        if sent < len(frame):
+            # The client's receive window is full, treat it as dead. A frame that
+            # was encoded but not sent would also break a compressed stream
+            self.shutdown()
+            return False
+        return True
+
+    def negotiate(self, data, compression):
+        offered = data.get("compression") or []
+        chosen = "zlib" if compression and "zlib" in offered else None
+
+        with self.send_lock:
+            frames = self.take_frames()
+            frames.append(self.encode({"command": "hello", "compression": chosen}))
+            self.unsent += frames
+            self.unsent_bytes += sum(len(frame) for frame in frames)
+            # The client waits for this answer before sending anything else
+            if chosen is not None:
+                self.codec.enable_compression()
+        self.flush()
+
+    def receive_frames(self):
+        """Reads what the socket has, returns the complete frames or None once the peer is gone."""
+        try:
+            chunk = self.socket.recv(self.data_payload)
+        except (BlockingIOError, InterruptedError):
+            return []
+        if not chunk:
+            return None
+        self.buffer += chunk
+        *frames, self.buffer = self.buffer.split(frame_delimiter)
+        if len(self.buffer) > self.max_frame_size or any(len(frame) > self.max_frame_size for frame in frames):
+            print(f"Dropping a connection that sent a frame over {self.max_frame_size} bytes")
+            return None
+        return frames
+
+    def shutdown(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.socket.close()
+
+
+class Timer:
+    def __init__(self, rounds, callback):
+        self.rounds = rounds
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Hashed timer wheel, O(1) schedule and cancel for every timeout in the server."""
+
+    def __init__(self, tick=0.5, size=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        self.position = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def schedule(self, delay, callback):
+        ticks = max(1, math.ceil(delay / self.tick))
+        size = len(self.slots)
+        timer = Timer((ticks - 1) // size, callback)
+
+        with self.lock:
+            self.slots[(self.position + ticks) % size].append(timer)
+        return timer
+
+    def advance(self):
+        due = []
+        with self.lock:
+            self.position = (self.position + 1) % len(self.slots)
+            remaining = []
+            for timer in self.slots[self.position]:
+                if timer.cancelled:
+                    continue
+                if timer.rounds > 0:
+                    timer.rounds -= 1
+                    remaining.append(timer)
+                else:
+                    due.append(timer)
+            self.slots[self.position] = remaining
+
+        for timer in due:
+            try:
+                timer.callback()
+            except Exception as e:
+                print(f"Error: Timer callback failed - {e}")
+
+    def run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self.stop_event.wait(max(0, next_tick - time.monotonic())):
+            self.advance()
+            next_tick += self.tick
+
+    def start(self):
+        self.stop_event.clear()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
 
-    def save_data(self):
-        with open(self.file_path, "wb") as file:
-            pickle.dump(self.users_data, file)
+
+class AccountWrite:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.done = threading.Event()
+        self.committed = False
+
+
+class AccountWriter:
+    """Appends queued registrations to the account store in groups with one fsync each.
+
+    Registrations are checked against every account, committed or queued, so
+    two connections can't both claim a name.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.pending = []
+        # Names queued or being written, not yet in the store
+        self.claimed = set()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.held = False
+        self.commits = 0
+        self.start()
+
+    def start(self):
+        with self.condition:
+            self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def create_user(self, credentials):
+        write = AccountWrite(credentials)
+        with self.condition:
+            if self.stopped or credentials.username in self.claimed or self.store.lookup(credentials.username):
+                return False
+            self.claimed.add(credentials.username)
+            self.pending.append(write)
+            self.condition.notify()
+        # Only answer once the account is on disk
+        write.done.wait()
+        return write.committed
+
+    def run(self):
+        while True:
+            with self.condition:
+                while (not self.pending or self.held) and not self.stopped:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                # Everything queued while the last group was being written goes in this one
+                group = self.pending
+                self.pending = []
+
+            committed = self.commit([write.credentials for write in group])
+            with self.condition:
+                for write in group:
+                    self.claimed.discard(write.credentials.username)
+            for write in group:
+                write.committed = committed
+                write.done.set()
+
+    def commit(self, accounts):
+        try:
+            self.store.append(accounts)
+        except OSError as e:
+            print(f"Error: Failed to save accounts - {e}")
+            return False
+        self.commits += 1
+        return True
+
+    def hold(self):
+        # Another process still owns the store, queue writes until it lets go
+        with self.condition:
+            self.held = True
+
+    def release(self):
+        with self.condition:
+            self.store.reopen()
+            for write in list(self.pending):
+                if self.store.lookup(write.credentials.username):
+                    # The other process registered the name first
+                    self.pending.remove(write)
+                    self.claimed.discard(write.credentials.username)
+                    write.done.set()
+            self.held = False
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+
+class CredentialsRepository:
+    """Shared by every connection, accounts are looked up in the store as they are needed."""
+
+    file_path = "./accounts"
+    # Where accounts were kept before the store, moved over the first time it opens
+    legacy_path = "./user_data.pkl"
+    # Longest username or password in bytes
+    max_field_length = 255
+
+    def __init__(self, account_writer):
+        self.account_writer = account_writer
+        self.store = account_writer.store
 
     def create_user(self, username, password):
-        if username not in self.users_data:
-            self.users_data[username] = Credentials(username, password)
-            self.save_data()
-            return True
-        return False
+        if max(len(username.encode()), len(password.encode())) > self.max_field_length:
+            return False
+        return self.account_writer.create_user(Credentials(username, password))
 
     def user_exists(self, username, password):
-        return any(
-            user.username == username and user.password == password
-            for user in self.users_data.values()
-        )
+        if username is None:
+            return False
+        credentials = self.store.lookup(username)
+        return credentials is not None and credentials.password == password
 
     def username_exists(self, username):
-        return any(user.username == username for user in self.users_data.values())
+        return username is not None and self.store.lookup(username) is not None
 
 
 class AuthManager:
-    def __init__(self, user_data, user_data_manager):
-        self.credentials_repository = CredentialsRepository()
+    def __init__(self, user_data, user_data_manager, credentials_repository):
+        self.credentials_repository = credentials_repository
         self.user_data = user_data
         self.user_data_manager = user_data_manager
 
     def login(self, username, password):
-        user_exists = self.credentials_repository.user_exists(username, password)
-        user_logged_in = self.user_data_manager.is_logged_in(username)
-
-        if user_logged_in:
-            return {"status": "failure", "message": "User is already logged in"}
-
-        can_log_in = user_exists and not user_logged_in
+        # Logging in on another device adds a session to the account, the
+        # existing ones, connected or waiting to be resumed, stay
+        can_log_in = self.credentials_repository.user_exists(username, password)
 
         if can_log_in:
             self.user_data.logged_in = True
-            self.user_data.display_name = username
-            return {"status": "success"}
+            self.user_data_manager.set_display_name(self.user_data, username)
+            self.user_data.resume_token = secrets.token_urlsafe(16)
+            return {"status": "success", "resume_token": self.user_data.resume_token}
 
         return {"status": "failure", "message": "Invalid credentials"}
 
@@ -109,7 +529,7 @@ class Command:
 
     def respond(self, data):
         data["ID"] = self.data["ID"]
-        self.socket.sendall(encrypt_message(json.dumps(data)))
+        self.socket.send_response(data["ID"], json.dumps(data).encode(), data)
 
     def execute(self):
         pass
@@ -175,58 +595,172 @@ class AdvertiseCommand(AuthCommand):
 
     def execute(self):
         if super().execute():
-            users = self.user_data_manager.get_users()
-            available_users = [
-                user.display_name
-                for user in users
-                if user.display_name != self.user_data.display_name
-            ]
+            users = self.user_data_manager.presence_snapshot().excluding(
+                self.user_data.display_name
+            )
+            # Spliced by hand so the shared snapshot never goes through json again
+            self.socket.send_response(
+                self.data["ID"],
+                b'{"status": "success", "users": ['
+                + users
+                + b'], "ID": '
+                + json.dumps(self.data["ID"]).encode()
+                + b"}"
+            )
 
-            self.respond({"status": "success", "users": available_users})
+
+class SearchCommand(AuthCommand):
+    max_page_size = 50
+
+    def __init__(self, socket, data, auth_manager, user_data_manager, user_data):
+        super().__init__(socket, data, auth_manager)
+        self.user_data_manager = user_data_manager
+        self.user_data = user_data
+
+    def execute(self):
+        if super().execute():
+            limit = max(1, min(self.data["limit"], self.max_page_size))
+            users, more = self.user_data_manager.search(
+                self.data["prefix"], self.data["after"], limit, self.user_data.display_name
+            )
+            self.respond({"status": "success", "users": users, "more": more})
 
 
 class ConnectCommand(AuthCommand):
     timeout = 60
+    handshake_lock = threading.Lock()
 
-    def __init__(self, socket, data, auth_manager, user_data_manager, user_data):
+    def __init__(
+        self, socket, data, auth_manager, user_data_manager, user_data, timer_wheel, workers
+    ):
         super().__init__(socket, data, auth_manager)
         self.user_data_manager = user_data_manager
         self.data = data
         self.user_data = user_data
+        self.timer_wheel = timer_wheel
+        self.workers = workers
+
+    def expire(self):
+        with self.handshake_lock:
+            if self.user_data.pending_connect is not self:
+                return
+            self.user_data.pending_connect = None
+            self.user_data.target = None
+        self.respond({"status": "failure", "message": "User not available"})
+
+    def accept(self, target_data):
+        self.user_data.connect_timer.cancel()
+        self.user_data.pending_connect = None
+        self.user_data.target = None
+        self.user_data.partner = target_data.display_name
+        self.respond({"status": "success", "username": self.user_data.display_name, "address":"", "port": target_data.port, "is_client": False})
 
     def execute(self):
         if super().execute():
             target = self.data["target"]
-            self.user_data.target = target
+            target_account = self.user_data_manager.find_account(target)
+            if target_account is None:
+                self.respond({"status": "failure", "message": "User not available"})
+                return
+
+            with self.handshake_lock:
+                # Any of the target's devices may be the one waiting for us
+                target_data = next(
+                    (
+                        session
+                        for session in target_account.sessions
+                        if session.pending_connect is not None
+                        and session.target == self.user_data.display_name
+                    ),
+                    None,
+                )
+                if target_data is not None:
+                    waiting = target_data.pending_connect
+                    self.respond({"status": "success", "username": self.user_data.display_name, "address": self.user_data.address, "port":self.user_data.port, "is_client": True})
+                    self.user_data.partner = target
+                    waiting.accept(self.user_data)
+                    return
+
+                # Park the request, the timer wheel answers it if nobody picks it up
+                if self.user_data.connect_timer is not None:
+                    self.user_data.connect_timer.cancel()
+                self.user_data.target = target
+                self.user_data.pending_connect = self
+                # Answered on a worker, a client that stops reading must not stall the timer thread
+                self.user_data.connect_timer = self.timer_wheel.schedule(
+                    self.timeout, lambda: self.workers.submit(self.expire)
+                )
+
+
+class MatchCommand(AuthCommand):
+    """Waits in the queue for anyone with the same criteria, answered when a partner turns up."""
+
+    max_criteria = 4
+    max_criterion_length = 32
+
+    def __init__(self, socket, data, auth_manager, user_data, matchmaker):
+        super().__init__(socket, data, auth_manager)
+        self.data = data
+        self.user_data = user_data
+        self.matchmaker = matchmaker
 
-            target_data = self.user_data_manager.get_user(target)
+    def criteria(self):
+        criteria = self.data["criteria"] or {}
+        if len(criteria) > self.max_criteria:
+            return None
+        for name, value in criteria.items():
+            if not isinstance(value, str) or max(len(name), len(value)) > self.max_criterion_length:
+                return None
+        return criteria
 
-            if target_data.target == self.user_data.display_name:
-                self.respond({"status": "success", "username": self.user_data.display_name, "address": self.user_data.address, "port":self.user_data.port, "is_client": True})
-                self.user_data.partner = target
-                self.user_data.available.set()
-            elif target_data.available.wait(self.timeout):
-                self.user_data.partner = target
-                self.respond({"status": "success", "username": self.user_data.display_name, "address":"", "port": target_data.port, "is_client": False})
-            else:
-                self.respond({"status": "failure", "message": "User not available"})
-            self.user_data.target = None
+    def matched(self, partner_name):
+        self.respond({"status": "success", "partner": partner_name})
+
+    def execute(self):
+        if super().execute():
+            criteria = self.criteria()
+            if criteria is None:
+                self.respond({"status": "failure", "message": "Invalid criteria"})
+            elif self.user_data.partner is not None:
+                self.respond({"status": "failure", "message": "Already chatting, quit first"})
+            elif not self.matchmaker.enter(self, criteria):
+                self.respond({"status": "failure", "message": "Already waiting"})
+
+
+class UnmatchCommand(AuthCommand):
+    def __init__(self, socket, data, auth_manager, user_data, matchmaker):
+        super().__init__(socket, data, auth_manager)
+        self.data = data
+        self.user_data = user_data
+        self.matchmaker = matchmaker
+
+    def execute(self):
+        if super().execute():
+            waiting = self.matchmaker.leave(self.user_data)
+            if waiting is None:
+                self.respond({"status": "failure", "message": "Not waiting"})
+                return
+            waiting.respond({"status": "failure", "message": "Left the queue"})
+            self.respond({"status": "success"})
 
 
 class MessageCommand(AuthCommand):
-    def __init__(self, socket, data, auth_manager, user_data_manager, user_data):
+    def __init__(self, socket, data, auth_manager, user_data_manager, user_data, archive=None):
         super().__init__(socket, data, auth_manager)
         self.user_data_manager = user_data_manager
         self.data = data
         self.user_data = user_data
+        self.archive = archive
 
-    def relay_message(self, socket, message):
+    def relay_message(self, partner_account, message):
         message_contents = {
             "command": "message",
             "username": self.user_data.display_name,
             "message": message,
         }
-        socket.sendall(encrypt_message(json.dumps(message_contents)))
+        partner_account.deliver(message_contents)
+        # The sender's other devices see the conversation too
+        self.user_data.account.deliver(message_contents, excluded=self.user_data)
 
     def system_message(self, socket, message):
         message_contents = {
@@ -234,160 +768,1525 @@ class MessageCommand(AuthCommand):
             "username": "",
             "message": message,
         }
-        socket.sendall(encrypt_message(json.dumps(message_contents)))
+        socket.send(message_contents)
 
     def execute(self):
         if super().execute():
-            partner_data = self.user_data_manager.get_user(self.user_data.partner)
+            partner_account = None
+            if self.user_data.partner is not None:
+                partner_account = self.user_data_manager.find_account(self.user_data.partner)
 
             if self.data.get("quit", False):
                 self.respond({"status": "failure", "message": "no partner"})
                 self.user_data.partner = None
-                partner_data.partner = None
-            elif self.user_data.partner is None:
+                if partner_account is not None:
+                    partner_account.partner = None
+            elif partner_account is None:
                 self.respond({"status": "failure", "message": "No partner"})
             else:
                 self.respond({"status": "success"})
-                self.relay_message(partner_data.socket, self.data["message"])
+                self.relay_message(partner_account, self.data["message"])
+                if self.archive is not None:
+                    self.archive.append(
+                        self.user_data.display_name, partner_account.name, self.data["message"]
+                    )
 
 
-class CommandFactory:
-    @staticmethod
-    def create_command(data, socket, user_data_manager, auth_manager, user_data):
-        print(data)
-        command = data["command"]
-
-        if command == "login":
-            return LoginCommand(socket, data, auth_manager)
-        elif command == "register":
-            return RegisterCommand(socket, data, auth_manager)
-        elif command == "advertise":
-            return AdvertiseCommand(
-                socket, data, auth_manager, user_data_manager, user_data
+class HistoryCommand(AuthCommand):
+    max_page_size = 50
+
+    def __init__(self, socket, data, auth_manager, user_data, archive):
+        super().__init__(socket, data, auth_manager)
+        self.user_data = user_data
+        self.archive = archive
+
+    def execute(self):
+        if super().execute():
+            if self.archive is None:
+                self.respond({"status": "failure", "message": "Message history is not kept"})
+                return
+
+            offset = max(0, self.data["offset"])
+            limit = max(1, min(self.data["limit"], self.max_page_size))
+            hits, total = self.archive.search(
+                self.data["username"], self.data["query"], offset, limit
             )
-        elif command == "connect":
-            return ConnectCommand(
-                socket, data, auth_manager, user_data_manager, user_data
+            self.respond(
+                {"status": "success", "messages": hits, "total": total, "more": offset + len(hits) < total}
             )
-        elif command == "message":
-            return MessageCommand(
-                socket, data, auth_manager, user_data_manager, user_data
+
+
+class ResumeCommand(Command):
+    def __init__(self, socket, data, user_data_manager, user_data):
+        super().__init__(socket, data)
+        self.user_data_manager = user_data_manager
+        self.user_data = user_data
+
+    def execute(self):
+        session = self.user_data_manager.claim_detached(self.data["token"])
+
+        if session is None:
+            self.respond({"status": "failure", "message": "Session expired"})
+            return
+
+        session.cancel_timers()
+        # Holding our own lock keeps messages forwarded from the old session
+        # queued behind the buffered ones
+        with self.user_data.lock:
+            with session.lock:
+                self.user_data_manager.set_display_name(self.user_data, session.display_name)
+                self.user_data.partner = session.partner
+                self.user_data.resume_token = secrets.token_urlsafe(16)
+                # Requests retried over the new connection get the answers sent to the old one,
+                # and this one's answer is kept with them
+                session.responses.claim(self.data["ID"])
+                self.user_data.responses = session.responses
+                self.socket.responses = session.responses
+                pending_messages = list(session.pending_messages)
+                session.pending_messages.clear()
+                session.forwarded_to = self.user_data
+            self.user_data_manager.delete_user(session)
+
+            self.respond(
+                {
+                    "status": "success",
+                    "username": self.user_data.display_name,
+                    "partner": self.user_data.partner,
+                    "resume_token": self.user_data.resume_token,
+                    "pending": len(pending_messages),
+                }
             )
+            for message in pending_messages:
+                self.socket.send(message, bulk_lane)
+
+
+class BoundedText:
+    """A string field of at most limit characters, for CommandSchema."""
+
+    def __init__(self, limit):
+        self.limit = limit
+
+
+class CommandSchema:
+    """Required fields and their types, checked in one pass before a command is built."""
+
+    def __init__(self, fields):
+        self.fields = tuple(fields.items())
+
+    def validate(self, data):
+        for name, kind in self.fields:
+            if name not in data:
+                return f"Missing field '{name}'"
+            value = data[name]
+            if isinstance(kind, BoundedText):
+                if not isinstance(value, str):
+                    return f"Invalid field '{name}'"
+                if len(value) > kind.limit:
+                    return f"Field '{name}' is longer than {kind.limit} characters"
+            elif not isinstance(value, kind):
+                return f"Invalid field '{name}'"
+        return None
+
+
+class ClientContext:
+    def __init__(
+        self,
+        connection,
+        user_data,
+        auth_manager,
+        user_data_manager,
+        timer_wheel,
+        archive=None,
+        matchmaker=None,
+        workers=None,
+    ):
+        self.connection = connection
+        self.user_data = user_data
+        self.auth_manager = auth_manager
+        self.user_data_manager = user_data_manager
+        self.timer_wheel = timer_wheel
+        self.archive = archive
+        self.matchmaker = matchmaker
+        self.workers = workers
+
+
+class CommandDispatcher:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, name, fields, build):
+        self.handlers[name] = (CommandSchema(fields), build)
+
+    @staticmethod
+    def command_name(data):
+        if isinstance(data, dict):
+            return data.get("command")
+        return None
+
+    @staticmethod
+    def request_id(data):
+        if isinstance(data, dict):
+            return data.get("ID")
+        return None
+
+    def prepare(self, data, context):
+        """Returns the command to execute, or the error to send back instead."""
+        handler = self.handlers.get(self.command_name(data))
+        if handler is None:
+            return None, "Unknown command"
+
+        schema, build = handler
+        error = schema.validate(data)
+        if error is not None:
+            return None, error
+        return build(data, context), None
+
+    def dispatch(self, data, context):
+        command, error = self.prepare(data, context)
+
+        if command is None:
+            response = {"status": "failure", "message": error, "ID": self.request_id(data)}
+            context.connection.send_response(response["ID"], json.dumps(response).encode(), response)
         else:
-            return None
+            command.execute()
+
+
+# Longest chat message in characters, relayed and archived as is
+max_message_length = 4096
+
+# Username and password may be unset when a client has not logged in yet,
+# AuthCommand answers those with an authorization failure
+credential_fields = {"ID": int, "username": (str, type(None)), "password": (str, type(None))}
+
+command_dispatcher = CommandDispatcher()
+command_dispatcher.register(
+    "login",
+    {"ID": int, "username": str, "password": str},
+    lambda data, context: LoginCommand(context.connection, data, context.auth_manager),
+)
+command_dispatcher.register(
+    "register",
+    {"ID": int, "username": str, "password": str},
+    lambda data, context: RegisterCommand(context.connection, data, context.auth_manager),
+)
+command_dispatcher.register(
+    "advertise",
+    credential_fields,
+    lambda data, context: AdvertiseCommand(
+        context.connection, data, context.auth_manager, context.user_data_manager, context.user_data
+    ),
+)
+command_dispatcher.register(
+    "search",
+    {**credential_fields, "prefix": str, "after": (str, type(None)), "limit": int},
+    lambda data, context: SearchCommand(
+        context.connection, data, context.auth_manager, context.user_data_manager, context.user_data
+    ),
+)
+command_dispatcher.register(
+    "connect",
+    {**credential_fields, "target": str},
+    lambda data, context: ConnectCommand(
+        context.connection,
+        data,
+        context.auth_manager,
+        context.user_data_manager,
+        context.user_data,
+        context.timer_wheel,
+        context.workers,
+    ),
+)
+command_dispatcher.register(
+    "match",
+    {**credential_fields, "criteria": (dict, type(None))},
+    lambda data, context: MatchCommand(
+        context.connection, data, context.auth_manager, context.user_data, context.matchmaker
+    ),
+)
+command_dispatcher.register(
+    "unmatch",
+    credential_fields,
+    lambda data, context: UnmatchCommand(
+        context.connection, data, context.auth_manager, context.user_data, context.matchmaker
+    ),
+)
+command_dispatcher.register(
+    "message",
+    {**credential_fields, "message": BoundedText(max_message_length)},
+    lambda data, context: MessageCommand(
+        context.connection,
+        data,
+        context.auth_manager,
+        context.user_data_manager,
+        context.user_data,
+        context.archive,
+    ),
+)
+command_dispatcher.register(
+    "history",
+    {**credential_fields, "query": str, "offset": int, "limit": int},
+    lambda data, context: HistoryCommand(
+        context.connection, data, context.auth_manager, context.user_data, context.archive
+    ),
+)
+command_dispatcher.register(
+    "resume",
+    {"ID": int, "token": str},
+    lambda data, context: ResumeCommand(
+        context.connection, data, context.user_data_manager, context.user_data
+    ),
+)
 
 
 class UserData:
+    pending_limit = 256
+
     def __init__(self, socket, address, port):
         self.socket = socket
+        self.lock = threading.Lock()
         self.display_name = None
+        self.account = None
         self.target = None
-        self.partner = None
-        self.available = Event()
+        self.pending_connect = None
+        self.connect_timer = None
+        self.heartbeat_timer = None
+        self.expiry_timer = None
+        self.resume_token = None
+        self.detached = False
+        self.forwarded_to = None
+        self.pending_messages = deque(maxlen=self.pending_limit)
+        # Answers to recent requests, handed to the connection that resumes the session
+        self.responses = ResponseCache()
         self.logged_in = True
         self.address = address
         self.port = port
+        self.last_seen = clock.now()
+        self.last_active = self.last_seen
+
+    # Chat partners belong to the account, every device talks to the same one
+    @property
+    def partner(self):
+        return self.account.partner if self.account is not None else None
+
+    @partner.setter
+    def partner(self, name):
+        if self.account is not None:
+            self.account.partner = name
+
+    def cancel_timers(self):
+        for timer in (self.connect_timer, self.heartbeat_timer, self.expiry_timer):
+            if timer is not None:
+                timer.cancel()
+
+    def deliver(self, data, payload=None):
+        with self.lock:
+            forwarded_to = self.forwarded_to
+            if forwarded_to is None:
+                if not self.detached:
+                    try:
+                        if payload is None:
+                            self.socket.send(data, bulk_lane)
+                        else:
+                            self.socket.send_payload(payload, data, bulk_lane)
+                        return
+                    except OSError:
+                        pass
+                # Kept for the client to collect when it resumes the session
+                self.pending_messages.append(data)
+                return
+        forwarded_to.deliver(data, payload)
+
+
+class Account:
+    """What one user shares across every device they are logged in on."""
+
+    def __init__(self, name):
+        self.name = name
+        self.sessions = []
+        self.partner = None
+
+    def deliver(self, data, excluded=None):
+        # Serialised once however many devices get it
+        payload = json.dumps(data).encode()
+        for session in list(self.sessions):
+            if session is not excluded:
+                session.deliver(data, payload)
+
+
+class PresenceSnapshot:
+    """The online names as one serialised JSON list body, cut per caller without re-encoding."""
+
+    def __init__(self, generation, names):
+        self.generation = generation
+        self.spans = {}
+        body = bytearray()
+        for name in names:
+            if body:
+                body += b", "
+            start = len(body)
+            body += json.dumps(name).encode()
+            self.spans[name] = (start, len(body))
+        self.body = bytes(body)
+
+    def excluding(self, name):
+        span = self.spans.get(name)
+        if span is None:
+            return self.body
+        start, end = span
+        # Take the separator on one side of the name along with it
+        if end < len(self.body):
+            end += 2
+        elif start:
+            start -= 2
+        return self.body[:start] + self.body[end:]
 
 
 class UserDataManager:
     def __init__(self):
         self.user_data = []
+        self.detached_sessions = {}
+        self.lock = threading.Lock()
+        # Bumped on every presence change, the snapshot is rebuilt lazily
+        self.generation = 0
+        self.snapshot = PresenceSnapshot(0, [])
+        # Online accounts by name, and their names sorted for prefix search
+        self.accounts = {}
+        self.directory = []
+
+    def presence_snapshot(self):
+        snapshot = self.snapshot
+        generation = self.generation
+        if snapshot.generation == generation:
+            return snapshot
+
+        with self.lock:
+            names = list(self.accounts)
+        snapshot = PresenceSnapshot(generation, names)
+        with self.lock:
+            # A newer rebuild may have raced us in
+            if snapshot.generation > self.snapshot.generation:
+                self.snapshot = snapshot
+        return snapshot
+
+    def join_account(self, user_data):
+        name = user_data.display_name
+        account = self.accounts.get(name)
+        if account is None:
+            account = self.accounts[name] = Account(name)
+            bisect.insort(self.directory, name)
+        account.sessions.append(user_data)
+        user_data.account = account
+
+    def leave_account(self, user_data):
+        account = user_data.account
+        account.sessions.remove(user_data)
+        if not account.sessions:
+            del self.accounts[account.name]
+            del self.directory[bisect.bisect_left(self.directory, account.name)]
+
+    def set_display_name(self, user_data, name):
+        with self.lock:
+            if user_data.account is not None:
+                self.leave_account(user_data)
+            user_data.display_name = name
+            self.join_account(user_data)
+            self.generation += 1
+
+    def search(self, prefix, after, limit, excluded):
+        """Up to limit online names starting with prefix and sorting after the cursor, and whether there are more."""
+        users = []
+        with self.lock:
+            position = bisect.bisect_left(self.directory, prefix)
+            if after is not None:
+                position = max(position, bisect.bisect_right(self.directory, after))
+            while position < len(self.directory):
+                name = self.directory[position]
+                if not name.startswith(prefix):
+                    break
+                if name != excluded:
+                    if len(users) == limit:
+                        return users, True
+                    users.append(name)
+                position += 1
+        return users, False
 
     def add_user_data(self, user_data):
         self.user_data.append(user_data)
+        with self.lock:
+            if user_data.display_name is not None:
+                self.join_account(user_data)
+            self.generation += 1
 
     def get_users(self):
         return self.user_data
 
-    def get_user(self, username):
-        return next(user for user in self.user_data if user.display_name == username)
+    def find_account(self, username):
+        return self.accounts.get(username)
 
     def delete_user(self, user_data):
         self.user_data.remove(user_data)
+        with self.lock:
+            if user_data.account is not None:
+                self.leave_account(user_data)
+            self.generation += 1
+
+    def detach_user(self, user_data):
+        with user_data.lock:
+            user_data.detached = True
+        with self.lock:
+            self.detached_sessions[user_data.resume_token] = user_data
+
+    def claim_detached(self, token):
+        with self.lock:
+            return self.detached_sessions.pop(token, None)
+
+
+class Matchmaker:
+    """Pairs users who want to chat with anyone, a queue per set of criteria so each match is O(1).
+
+    Queues are insertion ordered dicts keyed by session, the longest waiting
+    user is matched first and leaving the queue needs no search.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        # Which queue every waiting session is in
+        self.waiting = {}
+        self.matches = 0
+
+    def enter(self, command, criteria):
+        """Matches the command's user with whoever waited longest, or queues them. False if they already wait."""
+        user_data = command.user_data
+        key = tuple(sorted(criteria.items()))
+        # Waiting users who started chatting on another device since, told once the lock is released
+        taken = []
+        partner = None
+        with self.lock:
+            if user_data in self.waiting:
+                return False
+            queue = self.queues.get(key, {})
+            for waiting_data, waiting in list(queue.items()):
+                if waiting_data.partner is not None:
+                    taken.append(self.remove(waiting_data))
+                elif waiting_data.account is not user_data.account:
+                    partner = waiting
+                    break
+
+            if partner is None:
+                self.queues.setdefault(key, {})[user_data] = command
+                self.waiting[user_data] = key
+            else:
+                self.remove(partner.user_data)
+                user_data.partner = partner.user_data.display_name
+                partner.user_data.partner = user_data.display_name
+                self.matches += 1
+
+        for waiting in taken:
+            waiting.respond({"status": "failure", "message": "Already chatting, quit first"})
+        if partner is not None:
+            partner.matched(user_data.display_name)
+            command.matched(partner.user_data.display_name)
+        return True
+
+    def remove(self, user_data):
+        key = self.waiting.pop(user_data)
+        queue = self.queues[key]
+        command = queue.pop(user_data)
+        if not queue:
+            # Criteria nobody waits with any more leave nothing behind
+            del self.queues[key]
+        return command
+
+    def leave(self, user_data):
+        """Takes a session out of its queue, returns the command that was waiting or None."""
+        with self.lock:
+            if user_data not in self.waiting:
+                return None
+            return self.remove(user_data)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = clock.now()
+
+    def consume(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """Per-session token buckets, one for the session and one per command type."""
+
+    def __init__(self, session_limit, command_limits):
+        self.session_bucket = TokenBucket(*session_limit)
+        self.command_limits = command_limits
+        self.command_buckets = {}
+
+    def allow(self, command):
+        now = clock.now()
+
+        command_bucket = self.command_buckets.get(command)
+        if command_bucket is None and command in self.command_limits:
+            command_bucket = TokenBucket(*self.command_limits[command])
+            self.command_buckets[command] = command_bucket
+
+        if command_bucket is not None and not command_bucket.consume(now):
+            return False
+        return self.session_bucket.consume(now)
+
+
+class ResponseCache:
+    """The latest request IDs of one session and what they were answered with.
+
+    A client retrying a request that timed out sends the same ID again, and
+    gets the first answer back instead of the command running twice.
+    """
+
+    size = 64
+    # Larger answers are to reads like advertise, which are cheaper run again than kept
+    max_response_size = 4096
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # None while a request has not been answered yet
+        self.responses = OrderedDict()
+
+    def claim(self, request_id):
+        """(True, answer or None) for a repeated request, (False, None) for a new one, which is remembered."""
+        with self.lock:
+            if request_id in self.responses:
+                self.responses.move_to_end(request_id)
+                return True, self.responses[request_id]
+            self.responses[request_id] = None
+            if len(self.responses) > self.size:
+                self.responses.popitem(last=False)
+            return False, None
+
+    def record(self, request_id, payload):
+        with self.lock:
+            if request_id not in self.responses:
+                # Pushed out by newer requests while this one was parked
+                return
+            if len(payload) > self.max_response_size:
+                del self.responses[request_id]
+            else:
+                self.responses[request_id] = payload
+
+    def forget_pending(self):
+        with self.lock:
+            for request_id in [request_id for request_id, payload in self.responses.items() if payload is None]:
+                del self.responses[request_id]
+
+
+class AdmissionController:
+    """Decides on the accept thread whether a new connection may start a session."""
+
+    latency_smoothing = 0.1
+    # Seconds for the latency estimate to halve while no frames complete, so
+    # one stall can't keep every new client out; a stall still going on
+    # shows in the queued frames
+    latency_half_life = 5
+
+    def __init__(self, max_connections, max_connections_per_ip, max_in_flight, latency_threshold):
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.max_in_flight = max_in_flight
+        self.latency_threshold = latency_threshold
+
+        self.lock = threading.Lock()
+        self.connections_per_ip = {}
+        self.active = 0
+        self.in_flight = 0
+        self.latency = 0.0
+        self.latency_updated = time.perf_counter()
+
+    def admit(self, ip):
+        with self.lock:
+            if self.active >= self.max_connections:
+                return "Server busy - too many connections"
+            if self.connections_per_ip.get(ip, 0) >= self.max_connections_per_ip:
+                return "Server busy - too many connections from your address"
+            if self.in_flight >= self.max_in_flight or self.current_latency() > self.latency_threshold:
+                return "Server busy - try again later"
+
+            self.active += 1
+            self.connections_per_ip[ip] = self.connections_per_ip.get(ip, 0) + 1
+            return None
 
-    def is_logged_in(self, username):
-        return any(
-            user.display_name == username and user.logged_in for user in self.user_data
+    def release(self, ip):
+        with self.lock:
+            self.active -= 1
+            remaining = self.connections_per_ip[ip] - 1
+            if remaining:
+                self.connections_per_ip[ip] = remaining
+            else:
+                del self.connections_per_ip[ip]
+
+    def current_latency(self):
+        """The smoothed latency, decayed for the time since the last frame was handled. Needs the lock."""
+        idle = time.perf_counter() - self.latency_updated
+        return self.latency * 0.5 ** (idle / self.latency_half_life)
+
+    def frame_queued(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def frame_handled(self, queued_at):
+        """Counts the wait in the session's lanes too, that is where overload shows first."""
+        now = time.perf_counter()
+        elapsed = now - queued_at
+        with self.lock:
+            self.in_flight -= 1
+            latency = self.current_latency()
+            self.latency = latency + self.latency_smoothing * (elapsed - latency)
+            self.latency_updated = now
+
+
+class WorkerPool:
+    """A fixed set of threads running queued jobs, commands never get a thread of their own."""
+
+    def __init__(self, size):
+        self.jobs = queue.SimpleQueue()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(size)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as e:
+                print(f"Error: An unexpected error occurred - {e}")
+            # An idle worker must not keep the last session it served alive
+            del job
+
+    def stop(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+
+
+class ReaderLoop:
+    """Reads and decodes frames for many connections on one thread and queues them on their sessions."""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        # Sessions to start watching, handed over from other threads
+        self.incoming = deque()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def watch(self, session):
+        """Has the reader loop look again at what to watch the session's socket for."""
+        self.incoming.append(session)
+        self.wakeup_writer.send(b"\0")
+
+    def update(self, session):
+        if session.finished:
+            return
+        events = 0 if session.paused else selectors.EVENT_READ
+        if session.connection.watch_writes():
+            events |= selectors.EVENT_WRITE
+        client_socket = session.connection.socket
+        try:
+            registered = self.selector.get_key(client_socket).events
+        except KeyError:
+            registered = 0
+        if events == registered:
+            return
+        if not events:
+            self.selector.unregister(client_socket)
+        elif not registered:
+            self.selector.register(client_socket, events, session)
+        else:
+            self.selector.modify(client_socket, events, session)
+
+    def finish(self, session):
+        session.finished = True
+        try:
+            self.selector.unregister(session.connection.socket)
+        except KeyError:
+            pass
+        session.enqueue(None)
+
+    def run(self):
+        while not self.stopped:
+            events = self.selector.select()
+            profiling = self.profiler.active
+            if profiling:
+                self.profiler.label("read")
+            for key, mask in events:
+                session = key.data
+                if session is None:
+                    self.wakeup_reader.recv(4096)
+                    while self.incoming:
+                        self.update(self.incoming.popleft())
+                    continue
+                if session.finished:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    try:
+                        session.connection.flush()
+                    except OSError:
+                        # Seen as the end of the connection by the next read
+                        session.connection.shutdown()
+                        session.connection.unsent = []
+                if not mask & selectors.EVENT_READ:
+                    self.update(session)
+                elif not session.read():
+                    self.finish(session)
+                else:
+                    # Stop reading until the workers catch up, the client is
+                    # held back by its own send window meanwhile
+                    session.pause_if_backlogged()
+                    self.update(session)
+            if profiling:
+                self.profiler.unlabel()
+        self.selector.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup_writer.send(b"\0")
+
+
+# Queued in place of a frame that did not decode
+invalid_frame = object()
+
+
+class ClientSession:
+    """One client connection. Frames run on at most one worker at a time, in arrival
+    order within a lane, with control frames taken before queued chat messages.
+    """
+
+    # Frames taken per turn on a worker before other sessions get theirs
+    frames_per_turn = 16
+
+    def __init__(self, server, client_socket, address):
+        self.server = server
+        self.address = address
+        # Written to from workers and the reader loop, none of which may wait on a client
+        client_socket.setblocking(False)
+        self.connection = Connection(client_socket, server.data_payload)
+        self.connection.on_blocked = self.writes_blocked
+        if server.capture_writer is not None:
+            self.connection.capture = server.capture_writer.new_session()
+        self.connection.metrics = server.lane_metrics
+        self.user_data = UserData(self.connection, address[0], address[1])
+        self.connection.responses = self.user_data.responses
+        self.rate_limiter = RateLimiter(server.session_rate_limit, server.command_rate_limits)
+        auth_manager = AuthManager(self.user_data, server.user_data_manager, server.credentials_repository)
+        self.context = ClientContext(
+            self.connection,
+            self.user_data,
+            auth_manager,
+            server.user_data_manager,
+            server.timer_wheel,
+            server.archive,
+            server.matchmaker,
+            server.workers,
         )
 
+        self.lanes = (deque(), deque())
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.paused = False
+        self.reader = None
+        self.finished = False
+        self.closed = False
+        self.resumable = True
+
+    def writes_blocked(self):
+        if self.reader is not None:
+            self.reader.watch(self)
+
+    def read(self):
+        """Runs on the reader loop, returns False once the connection is finished."""
+        try:
+            frames = self.connection.receive_frames()
+        except OSError:
+            return False
+        if frames is None:
+            return False
+
+        profiler = self.server.profiler
+        for frame in frames:
+            try:
+                if profiler.active:
+                    started = time.perf_counter()
+                    data = self.connection.codec.decode(frame)
+                    profiler.record("decode", time.perf_counter() - started)
+                else:
+                    data = self.connection.codec.decode(frame)
+            except json.JSONDecodeError:
+                # Answered by a worker, the reader never writes to a client that may not be reading
+                self.enqueue(invalid_frame, control_lane)
+                continue
+            except Exception as e:
+                print(f"Error: An unexpected error occurred - {e}")
+                return False
+            if self.connection.capture is not None:
+                self.connection.capture.inbound(data)
+
+            self.user_data.last_seen = clock.now()
+            command = command_dispatcher.command_name(data)
+            if command == "pong":
+                continue
+            elif command == "hello":
+                # Answered before the next frame is decoded, which may already be compressed
+                try:
+                    self.connection.negotiate(data, self.server.compression)
+                except OSError:
+                    # Gone before the answer went out, must not take the reader down with it
+                    return False
+                continue
+            self.enqueue(data, self.lane(command))
+        return True
+
+    @staticmethod
+    def lane(command):
+        # A quit too, so it ends the chat only after the messages sent before it
+        if command == "message":
+            return bulk_lane
+        return control_lane
+
+    def queued(self):
+        return len(self.lanes[control_lane]) + len(self.lanes[bulk_lane])
+
+    def pause_if_backlogged(self):
+        with self.lock:
+            self.paused = self.queued() >= self.server.max_queued_frames
+            return self.paused
+
+    def enqueue(self, data, lane=bulk_lane):
+        self.server.admission.frame_queued()
+        # The end of the connection goes on the bulk lane, behind everything else
+        with self.lock:
+            self.lanes[lane].append((data, time.perf_counter()))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.server.workers.submit(self.run)
+
+    def run(self):
+        for _ in range(self.frames_per_turn):
+            with self.lock:
+                lane = control_lane if self.lanes[control_lane] else bulk_lane
+                if not self.lanes[lane]:
+                    self.scheduled = False
+                    return
+                data, queued_at = self.lanes[lane].popleft()
+                resume = self.paused and self.queued() < self.server.max_queued_frames // 2
+                if resume:
+                    self.paused = False
+            if resume:
+                self.reader.watch(self)
+            self.server.lane_metrics.record("inbound", lane, time.perf_counter() - queued_at)
+            try:
+                self.handle(data)
+            finally:
+                self.server.admission.frame_handled(queued_at)
+        # Back of the line so one busy session can't hold a worker
+        self.server.workers.submit(self.run)
+
+    def handle(self, data):
+        if self.closed:
+            return
+        if data is None:
+            self.closed = True
+            self.server.close_client(self.connection, self.user_data, self.address, self.resumable)
+            return
+
+        command = command_dispatcher.command_name(data)
+        try:
+            if data is invalid_frame:
+                self.connection.send({"status": "failure", "message": "Invalid JSON"})
+            elif command == "close":
+                self.resumable = False
+                # The reader sees the connection end and queues the cleanup
+                self.connection.shutdown()
+            elif self.server.handing_off.is_set():
+                # State is being frozen for the next process, the client
+                # resumes there once this connection closes
+                self.connection.send(
+                    {
+                        "status": "failure",
+                        "message": "Server restarting, try again",
+                        "ID": command_dispatcher.request_id(data),
+                    }
+                )
+            elif not self.rate_limiter.allow(command):
+                # Not remembered, a retry once the limit allows is run
+                self.connection.send(
+                    {
+                        "status": "failure",
+                        "message": "Rate limit exceeded",
+                        "ID": command_dispatcher.request_id(data),
+                    }
+                )
+            elif self.repeated(data):
+                # A retry, answered from the cache
+                pass
+            else:
+                self.user_data.last_active = self.user_data.last_seen
+                profiler = self.server.profiler
+                profiling = profiler.active
+                if profiling:
+                    label = command if command in command_dispatcher.handlers else "unknown"
+                    profiler.label(label)
+                    profile_started = time.perf_counter()
+                try:
+                    with WriteBatch():
+                        command_dispatcher.dispatch(data, self.context)
+                finally:
+                    if profiling:
+                        profiler.unlabel()
+                        profiler.record(label, time.perf_counter() - profile_started)
+        except KeyError as e:
+            print(f"Error: Missing key in received data - {e}")
+            self.connection.shutdown()
+        except OSError:
+            # The client went away, its reader queues the cleanup
+            self.connection.shutdown()
+        except Exception as e:
+            print(f"Error: An unexpected error occurred - {e}")
+            self.connection.shutdown()
+
+    def repeated(self, data):
+        """Resends the answer to a request seen before, True if data is one."""
+        request_id = command_dispatcher.request_id(data)
+        if type(request_id) is not int:
+            return False
+        seen, payload = self.connection.responses.claim(request_id)
+        if seen and payload is not None:
+            self.connection.send_payload(payload)
+        # Still parked, like a connect nobody answered yet, the first answer goes to the retry too
+        return seen
+
 
 class Server:
     data_payload = 2048
-    backlog = 5
-
-    def __init__(self, host, port):
+    backlog = 128
+    max_connections = 1024
+    max_connections_per_ip = 32
+    max_in_flight = 256
+    latency_threshold = 0.5
+    reject_timeout = 0.5
+    # (tokens per second, burst size)
+    session_rate_limit = (20, 40)
+    command_rate_limits = {
+        "login": (1, 5),
+        "register": (0.2, 3),
+        "advertise": (2, 5),
+        "connect": (1, 3),
+        "message": (10, 20),
+        "resume": (1, 3),
+        "match": (1, 5),
+        "unmatch": (1, 5),
+    }
+    heartbeat_interval = 15
+    dead_timeout = 45
+    idle_timeout = 1800
+    resume_window = 120
+    accept_poll_interval = 0.5
+    reader_threads = 2
+    worker_threads = 16
+    # Frames a session may have waiting before its reader stops reading it
+    max_queued_frames = 64
+    # Seconds between printed per-lane latency reports, None to stay quiet
+    lane_report_interval = None
+    drain_timeout = 10
+    capture_path = None
+    # Where profiles started with SIGUSR1 are written, and how long they run
+    profile_path = "./profiles"
+    profile_window = 30
+    # Directory for the searchable message archive, None keeps no history
+    archive_path = None
+    # Seconds between saves of the archive index, so a restart re-reads little
+    archive_checkpoint_interval = 300
+    compression = True
+    no_delay = True
+    # None keeps the operating system's default socket buffer sizes
+    send_buffer_size = None
+    receive_buffer_size = None
+
+    def __init__(self, host, port, transport=None):
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        self.connections = []
+        self.transport = transport or TcpTransport(
+            self.no_delay, self.send_buffer_size, self.receive_buffer_size
+        )
+        self.server_socket = None
+        self.stopped = threading.Event()
+        self.handing_off = threading.Event()
+        self.accept_stopped = threading.Event()
+        # Set once a handoff either completed or was called off
+        self.handoff_finished = threading.Event()
+
+        self.profiler = Profiler(self.profile_path)
+        self.readers = [ReaderLoop(self.profiler) for _ in range(self.reader_threads)]
+        self.next_reader = 0
+        self.workers = WorkerPool(self.worker_threads)
+        self.lane_metrics = LaneMetrics()
         self.user_data_manager = UserDataManager()
+        self.matchmaker = Matchmaker()
+        self.timer_wheel = TimerWheel()
+        if self.lane_report_interval:
+            self.timer_wheel.schedule(self.lane_report_interval, self.report_lanes)
+        self.account_store = AccountStore(CredentialsRepository.file_path)
+        imported = self.account_store.import_pickle(CredentialsRepository.legacy_path)
+        if imported:
+            print(f"Moved {imported} accounts from {CredentialsRepository.legacy_path}")
+        self.account_writer = AccountWriter(self.account_store)
+        self.credentials_repository = CredentialsRepository(self.account_writer)
+        self.capture_writer = CaptureWriter(self.capture_path) if self.capture_path else None
+        self.archive = Archive(self.archive_path) if self.archive_path else None
+        if self.archive is not None:
+            self.timer_wheel.schedule(self.archive_checkpoint_interval, self.checkpoint_archive)
+        self.admission = AdmissionController(
+            self.max_connections,
+            self.max_connections_per_ip,
+            self.max_in_flight,
+            self.latency_threshold,
+        )
 
-    def close_client(self, client_socket, user_data, address):
-        client_socket.close()
+    def close_client(self, connection, user_data, address, resumable):
+        user_data.cancel_timers()
+        user_data.pending_connect = None
+        user_data.target = None
+        # Nobody gets matched with a connection that is gone, a resumed client queues again
+        self.matchmaker.leave(user_data)
+        # Parked requests are never answered now, their retries must run again
+        user_data.responses.forget_pending()
+        connection.close()
+        if connection.capture is not None:
+            connection.capture.close()
         print(f"Connection from {address} closed")
+        self.admission.release(address[0])
+
+        if resumable and user_data.resume_token is not None:
+            self.detach_session(user_data)
+        else:
+            self.user_data_manager.delete_user(user_data)
+
+    def detach_session(self, user_data):
+        # Keep the session around briefly so a flaky client can pick it up
+        self.user_data_manager.detach_user(user_data)
+        # Telling the partner writes to their socket, which is a worker's job and not the timer thread's
+        user_data.expiry_timer = self.timer_wheel.schedule(
+            self.resume_window, lambda: self.workers.submit(lambda: self.expire_session(user_data))
+        )
+
+    def expire_session(self, user_data):
+        if self.user_data_manager.claim_detached(user_data.resume_token) is not user_data:
+            return
+
+        partner = user_data.partner
         self.user_data_manager.delete_user(user_data)
+        print(f"Session for {user_data.display_name} expired")
+
+        if partner is None or self.user_data_manager.find_account(user_data.display_name) is not None:
+            # Still around on another device
+            return
+        partner_account = self.user_data_manager.find_account(partner)
+        if partner_account is not None and partner_account.partner == user_data.display_name:
+            partner_account.partner = None
+            partner_account.deliver(
+                {"command": "message", "username": "", "message": f"{user_data.display_name} disconnected"}
+            )
 
-    def handle_client(self, client_socket, address):
-        user_data = UserData(client_socket, address[0], address[1])
-        auth_manager = AuthManager(user_data, self.user_data_manager)
+    def reject_client(self, client_socket, address, reason):
+        # Runs on the accept thread, so never wait long on a slow client
+        client_socket.settimeout(self.reject_timeout)
+        try:
+            client_socket.sendall(
+                Connection(client_socket, self.data_payload).encode(
+                    {"command": "busy", "status": "failure", "message": reason}
+                )
+            )
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+        print(f"Rejected connection from {address}: {reason}")
+
+    def schedule_heartbeat(self, connection, user_data):
+        user_data.heartbeat_timer = self.timer_wheel.schedule(
+            self.heartbeat_interval, lambda: self.heartbeat(connection, user_data)
+        )
+
+    def heartbeat(self, connection, user_data):
+        now = clock.now()
+        silent_for = now - user_data.last_seen
+
+        if silent_for > self.dead_timeout or now - user_data.last_active > self.idle_timeout:
+            # Its reader sees the connection end and the session is cleaned up
+            print(f"Evicting idle connection from {(user_data.address, user_data.port)}")
+            connection.shutdown()
+            return
+
+        if silent_for >= self.heartbeat_interval:
+            connection.try_send({"command": "ping"})
+        self.schedule_heartbeat(connection, user_data)
+
+    def report_lanes(self):
+        for direction, lane, frames, median, tail in self.lane_metrics.summary():
+            print(
+                f"{direction} {lane}: {frames} frames, queued p50 {median * 1e3:.2f}ms p99 {tail * 1e3:.2f}ms"
+            )
+        self.timer_wheel.schedule(self.lane_report_interval, self.report_lanes)
 
-        self.user_data_manager.add_user_data(user_data)
+    def checkpoint_archive(self):
+        # Pickling the index can take a while, it runs on a worker and not the timer thread
+        self.workers.submit(self.archive.checkpoint)
+        self.timer_wheel.schedule(self.archive_checkpoint_interval, self.checkpoint_archive)
 
+    def accept_client(self, client_socket, address):
+        session = ClientSession(self, client_socket, address)
+        self.user_data_manager.add_user_data(session.user_data)
+        self.schedule_heartbeat(session.connection, session.user_data)
         print(f"Accepted connection from {address}")
-        # Handle client communication here
-        # For example, you can use client_socket.recv() to receive data from the client
-        # and client_socket.send() to send data to the client
-        try:
-            while True:
-                data = json.loads(decrypt_message(client_socket.recv(self.data_payload)))
-                if data["command"] == "close":
-                    break
-                else:
-                    command = CommandFactory.create_command(
-                        data,
-                        client_socket,
-                        self.user_data_manager,
-                        auth_manager,
-                        user_data,
-                    )
-                    command.execute()
-        except json.JSONDecodeError:
-            print("Error: Invalid JSON data received from the client.")
-            self.close_client(client_socket, user_data, address)
-            # Handle the error or log it as needed
-        except KeyError as e:
-            print(f"Error: Missing key in received data - {e}")
-            self.close_client(client_socket, user_data, address)
-            # Handle the error or log it as needed
-        except Exception as e:
-            print(f"Error: An unexpected error occurred - {e}")
-            self.close_client(client_socket, user_data, address)
 
-    def start(self):
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(self.backlog)
+        session.reader = self.readers[self.next_reader]
+        self.next_reader = (self.next_reader + 1) % len(self.readers)
+        session.reader.watch(session)
+
+    def listen(self):
+        self.server_socket = self.transport.listen(self.host, self.port, self.backlog)
         print(f"Server listening on {self.host}:{self.port}...")
 
+    def stop(self):
+        self.stopped.set()
+        if self.server_socket is not None:
+            self.server_socket.close()
+        self.timer_wheel.stop()
+        for reader in self.readers:
+            reader.stop()
+        self.workers.stop()
+        self.account_writer.stop()
+        self.account_store.close()
+        if self.capture_writer is not None:
+            self.capture_writer.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def serve(self):
+        # Polls rather than blocking in accept, so serving can stop without
+        # shutting down a listening socket another process may share
+        selector = selectors.DefaultSelector()
+        selector.register(self.server_socket, selectors.EVENT_READ)
+
+        while not self.stopped.is_set() and not self.handing_off.is_set():
+            if not selector.select(self.accept_poll_interval):
+                continue
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except OSError as e:
+                if self.stopped.is_set():
+                    break
+                print(f"Error: Failed to accept a connection - {e}")
+                continue
+
+            reason = self.admission.admit(client_address[0])
+            if reason is not None:
+                self.reject_client(client_socket, client_address, reason)
+                continue
+            self.transport.configure(client_socket)
+
+            self.accept_client(client_socket, client_address)
+        selector.close()
+        self.accept_stopped.set()
+
+    def export_sessions(self):
+        sessions = []
+        for user_data in list(self.user_data_manager.get_users()):
+            if user_data.display_name is None or user_data.resume_token is None:
+                continue
+            with user_data.lock:
+                sessions.append(
+                    {
+                        "username": user_data.display_name,
+                        "partner": user_data.partner,
+                        "resume_token": user_data.resume_token,
+                        "pending_messages": list(user_data.pending_messages),
+                    }
+                )
+        return sessions
+
+    def import_sessions(self, sessions):
+        for session in sessions:
+            user_data = UserData(None, "", 0)
+            user_data.display_name = session["username"]
+            user_data.resume_token = session["resume_token"]
+            user_data.pending_messages.extend(session["pending_messages"])
+            # Has no socket, a relay reaching it before detach_session must queue the message
+            user_data.detached = True
+            self.user_data_manager.add_user_data(user_data)
+            # A device that logged in here during the drain keeps its own partner
+            if user_data.partner is None:
+                user_data.partner = session["partner"]
+            self.detach_session(user_data)
+
+    def listen_for_handoff(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        handoff_socket.bind(path)
+        handoff_socket.listen(1)
+        threading.Thread(
+            target=self.wait_for_handoff, args=(handoff_socket, path), daemon=True
+        ).start()
+
+    def wait_for_handoff(self, handoff_socket, path):
         while True:
-            client_socket, client_address = self.server_socket.accept()
-            client_thread = threading.Thread(
-                target=self.handle_client, args=(client_socket, client_address)
-            )
-            client_thread.start()
-            self.connections.append(client_thread)
+            channel, _ = handoff_socket.accept()
+            with channel:
+                if read_line(channel) != b"takeover":
+                    continue
+                print("Handing off to a new server process...")
+                if self.hand_off(channel):
+                    break
+        handoff_socket.close()
 
+    def hand_off(self, channel):
+        """Runs in the old process: give away the listener, drain, then move every session.
+
+        Returns False, serving on, if the new process never confirmed it took the sessions.
+        """
+        self.handing_off.set()
+        # Connections arriving meanwhile wait in the backlog for the new process,
+        # none are refused and none are accepted here after the handoff began
+        self.accept_stopped.wait()
+        try:
+            socket.send_fds(channel, [b"L"], [self.server_socket.fileno()])
+
+            deadline = time.monotonic() + self.drain_timeout
+            while self.admission.in_flight and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.account_writer.stop()
+
+            channel.sendall(json.dumps(self.export_sessions()).encode() + b"\n")
+            # Clients are only cut off once their sessions can be resumed over there
+            ready = read_line(channel)
+        except OSError as e:
+            print(f"Error: Handoff failed - {e}")
+            ready = None
+        if ready != b"ready":
+            self.call_off_handoff()
+            return False
+
+        for user_data in list(self.user_data_manager.get_users()):
+            if user_data.socket is not None:
+                user_data.socket.shutdown()
+        self.stopped.set()
+        self.timer_wheel.stop()
+        if self.capture_writer is not None:
+            self.capture_writer.close()
+        if self.archive is not None:
+            self.archive.close()
+        self.server_socket.close()
+        print("Handoff complete")
+        self.handoff_finished.set()
+        return True
+
+    def call_off_handoff(self):
+        """The new process died or never answered, this one keeps every session and serves on."""
+        print("Handoff called off, serving on")
+        if self.account_writer.stopped:
+            self.account_writer.start()
+        self.accept_stopped.clear()
+        self.handing_off.clear()
+        self.handoff_finished.set()
+
+    def take_over(self, path):
+        """Used instead of listen in the new process: adopt the old process's listener and sessions."""
+        self.account_writer.hold()
+        channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        channel.connect(path)
+        channel.sendall(b"takeover\n")
+        _, descriptors, _, _ = socket.recv_fds(channel, 1, 1)
+        if not descriptors:
+            channel.close()
+            raise OSError("the old server sent no listener")
+        self.server_socket = socket.socket(fileno=descriptors[0])
+        print(f"Took over listener on {self.server_socket.getsockname()}")
+
+        # Accept right away while the old process is still draining
+        threading.Thread(target=self.adopt_sessions, args=(channel, path)).start()
+
+    def adopt_sessions(self, channel, path):
+        try:
+            with channel:
+                self.import_sessions(json.loads(read_line(channel)))
+                channel.sendall(b"ready\n")
+        except Exception as e:
+            # The old process died mid-handoff, its clients log in again instead of resuming
+            print(f"Error: Could not adopt sessions from the old server - {e}")
+        # The old process has committed its last registration and message by now, or is gone
+        self.account_writer.release()
+        if self.archive is not None:
+            self.archive.catch_up()
+        # The old process is done with the path, the next restart goes through us
+        self.listen_for_handoff(path)
+
+    def start(self, takeover_path=None):
+        if takeover_path is None:
+            self.listen()
+        else:
+            self.take_over(takeover_path)
+        self.timer_wheel.start()
+        while True:
+            self.serve()
+            if not self.handing_off.is_set():
+                return
+            # Every other thread is a daemon, the process must live until the handoff is done
+            self.handoff_finished.wait()
+            self.handoff_finished.clear()
+            if self.stopped.is_set():
+                return
+
+
+def server_settings():
+    module = sys.modules[__name__]
+    return [
+        Setting("host", None, None, text, "address to listen on"),
+        Setting("port", None, None, integer, "port to listen on"),
+        Setting("backlog", Server, "backlog", integer, "connections the kernel queues before accept"),
+        Setting("data_payload", Server, "data_payload", integer, "bytes read from a socket per recv"),
+        Setting("max_frame_size", Connection, "max_frame_size", integer, "longest frame a client may send, in bytes"),
+        Setting("max_queued_bytes", Connection, "max_queued_bytes", integer, "bytes queued for a client before it is cut off as too slow"),
+        Setting("send_buffer_size", Server, "send_buffer_size", optional(integer), "SO_SNDBUF of client sockets"),
+        Setting("receive_buffer_size", Server, "receive_buffer_size", optional(integer), "SO_RCVBUF of client sockets"),
+        Setting("no_delay", Server, "no_delay", flag, "disable Nagle's algorithm"),
+        Setting("compression", Server, "compression", flag, "offer zlib compression to clients"),
+        Setting("max_frames_per_write", module, "max_frames_per_write", integer, "frames handed to one sendmsg"),
+        Setting("bulk_frames_per_write", module, "bulk_frames_per_write", integer, "chat frames sent per flush behind control frames"),
+        Setting("reader_threads", Server, "reader_threads", integer, "threads reading and decoding frames"),
+        Setting("worker_threads", Server, "worker_threads", integer, "threads running commands"),
+        Setting("max_queued_frames", Server, "max_queued_frames", integer, "frames a session may queue before its reads pause"),
+        Setting("max_connections", Server, "max_connections", integer, "connections served at once"),
+        Setting("max_connections_per_ip", Server, "max_connections_per_ip", integer, "connections served at once per address"),
+        Setting("max_in_flight", Server, "max_in_flight", integer, "commands running or queued before new clients are turned away"),
+        Setting("latency_threshold", Server, "latency_threshold", number, "seconds of smoothed command latency before new clients are turned away"),
+        Setting("session_rate_limit", Server, "session_rate_limit", pair, "commands per second and burst for one session"),
+        Setting("response_cache_size", ResponseCache, "size", integer, "answered requests a session remembers for retries"),
+        Setting("heartbeat_interval", Server, "heartbeat_interval", number, "seconds between pings"),
+        Setting("dead_timeout", Server, "dead_timeout", number, "seconds without a pong before a connection is dropped"),
+        Setting("idle_timeout", Server, "idle_timeout", number, "seconds without a command before a connection is dropped"),
+        Setting("resume_window", Server, "resume_window", number, "seconds a dropped session can be resumed"),
+        Setting("connect_timeout", ConnectCommand, "timeout", number, "seconds a connect request waits for the other side"),
+        Setting("drain_timeout", Server, "drain_timeout", number, "seconds a handoff waits for running commands"),
+        Setting("accounts", CredentialsRepository, "file_path", text, "account store, without the .log and .idx extensions"),
+        Setting("capture", Server, "capture_path", optional(text), "record every session to this file for replay.py"),
+        Setting("archive", Server, "archive_path", optional(text), "keep a searchable history of relayed messages in this directory"),
+        Setting("archive_checkpoint_interval", Server, "archive_checkpoint_interval", number, "seconds between saves of the archive index"),
+        Setting("lane_report", Server, "lane_report_interval", optional(number), "print queueing latency per priority lane every this many seconds"),
+        Setting("profile_dir", Server, "profile_path", text, "where profiles started with SIGUSR1 are written"),
+        Setting("profile_window", Server, "profile_window", number, "seconds a profile runs unless SIGUSR1 stops it sooner"),
+    ]
+
+
+def auto_tune(configuration, mode):
+    probe = LoadProbe(lambda: FrameCodec(fernet), os.path.dirname(configuration["accounts"]) or ".")
+    measurements = probe.run()
+    for name, (value, reason) in suggest(measurements).items():
+        if configuration.sources[name] != "default":
+            # Whatever was set explicitly wins over the probe
+            print(f"auto-tune: {name} {value} ({reason}), keeping {configuration[name]} from {configuration.sources[name]}")
+        elif mode == "apply":
+            configuration.set(name, value, "auto-tune")
+            print(f"auto-tune: {name} {value} ({reason})")
+        else:
+            print(f"auto-tune: {name} could be {value} ({reason}), running with {configuration[name]}")
 
-if __name__ == "__main__":
-    server = Server("localhost", 20)  # Change the IP address and port as needed
-    server.start()
 
+def read_line(channel):
+    line = b""
+    while not line.endswith(b"\n"):
+        chunk = channel.recv(65536)
+        if not chunk:
+            break
+        line += chunk
+    return line.rstrip(b"\n")
 
-# if __name__ == '__main__':
-#     parser = argparse.ArgumentParser(description='Socket Server Example')
-#     parser.add_argument('--port', action="store",
-#                         dest="port", type=int, required=True)
-#     given_args = parser.parse_args()
-#     port = given_args.port
-#     dumb_chat_server(port)
+
+if __name__ == "__main__":
+    configuration = Configuration(server_settings(), host="localhost", port=20)
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--config", help="JSON file of settings, overridden by CHAT_* variables and flags")
+    parser.add_argument(
+        "--auto-tune",
+        dest="auto_tune",
+        choices=("off", "suggest", "apply"),
+        default="off",
+        help="measure this machine at startup and print or apply better settings",
+    )
+    parser.add_argument(
+        "--show-config", dest="show_config", action="store_true", help="print every setting and where it came from"
+    )
+    parser.add_argument(
+        "--handoff", help="unix socket a replacement process can take over from"
+    )
+    parser.add_argument(
+        "--take-over",
+        dest="take_over",
+        action="store_true",
+        help="take over the port and sessions of the server on --handoff instead of binding",
+    )
+    configuration.add_arguments(parser)
+    given_args = parser.parse_args()
+    try:
+        configuration.load(given_args, given_args.config)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if given_args.auto_tune != "off":
+        auto_tune(configuration, given_args.auto_tune)
+    configuration.apply()
+    if given_args.show_config:
+        for line in configuration.describe():
+            print(line)
+
+    server = Server(configuration["host"], configuration["port"])
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> starts a profile, a second one ends it early
+        signal.signal(
+            signal.SIGUSR1, lambda signum, frame: server.profiler.toggle(Server.profile_window)
+        )
+    # Ends like Ctrl-C, so the archive index and account store are closed cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if given_args.take_over:
+            try:
+                server.start(given_args.handoff)
+            except OSError as e:
+                print(f"Error: Could not take over from {given_args.handoff} - {e}")
+                sys.exit(1)
+        else:
+            if given_args.handoff:
+                server.listen_for_handoff(given_args.handoff)
+            server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Already done by a completed handoff
+        if not server.stopped.is_set():
+            server.stop()
@@ -0,0 +1,195 @@
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import server as server_module
+from chat_client import ClientPool
+from server import CredentialsRepository, Server
+from transport import MemoryTransport
+
+
+class SimulatedClock:
+    """Time only moves when the harness advances it, firing timers tick by tick."""
+
+    def __init__(self, start=0.0):
+        self.current = start
+        self.timer_wheels = {}
+
+    def now(self):
+        return self.current
+
+    def attach(self, timer_wheel):
+        self.timer_wheels[timer_wheel] = self.current + timer_wheel.tick
+
+    def advance(self, seconds):
+        target = self.current + seconds
+        while self.timer_wheels:
+            timer_wheel, next_tick = min(self.timer_wheels.items(), key=lambda item: item[1])
+            if next_tick > target:
+                break
+            self.current = next_tick
+            self.timer_wheels[timer_wheel] = next_tick + timer_wheel.tick
+            timer_wheel.advance()
+        self.current = target
+
+
+class Simulation:
+    host = "simulation"
+    port = 1
+    password = "password"
+    # Real time given to client and handler threads to react between steps
+    settle_time = 0.05
+
+    def __init__(self):
+        self.clock = SimulatedClock()
+        server_module.clock = self.clock
+
+        self.data_directory = tempfile.TemporaryDirectory()
+        CredentialsRepository.file_path = os.path.join(self.data_directory.name, "accounts")
+
+        self.transport = MemoryTransport()
+        self.server = Server(self.host, self.port, self.transport)
+        # Throughput runs measure the protocol, not the abuse limits
+        self.server.session_rate_limit = (1e9, 1e9)
+        self.server.command_rate_limits = {}
+        self.server.max_connections = sys.maxsize
+        self.server.admission.max_connections = sys.maxsize
+        self.server.admission.max_in_flight = sys.maxsize
+        self.server.admission.latency_threshold = float("inf")
+        self.clock.attach(self.server.timer_wheel)
+
+        self.client_pool = ClientPool(self.host, self.port, self.transport)
+
+    def start(self):
+        self.server.listen()
+        threading.Thread(target=self.server.serve, daemon=True).start()
+
+    def stop(self):
+        self.client_pool.close()
+        self.server.stop()
+        self.data_directory.cleanup()
+
+    def add_client(self, username):
+        controller = self.client_pool.open()
+        controller.register(username, self.password)
+        controller.login(username, self.password)
+        return controller
+
+    def settle(self):
+        time.sleep(self.settle_time)
+
+    def run_for(self, seconds, step):
+        elapsed = 0
+        while elapsed < seconds:
+            self.clock.advance(step)
+            self.settle()
+            elapsed += step
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def handshake_race(simulation, pairs):
+    """Both sides of every pair send connect at the same instant."""
+    failures = 0
+
+    for first, second in pairs:
+        barrier = threading.Barrier(2)
+        responses = {}
+
+        def connect(controller, target):
+            barrier.wait()
+            responses[controller] = controller.connect(target)
+
+        threads = [
+            threading.Thread(target=connect, args=(first, second.user_data.username)),
+            threading.Thread(target=connect, args=(second, first.user_data.username)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        roles = sorted(response.get("is_client", None) is True for response in responses.values())
+        if any(response["status"] != "success" for response in responses.values()) or roles != [False, True]:
+            failures += 1
+
+    return failures
+
+
+def message_round_trips(pairs, messages):
+    latencies = []
+    lock = threading.Lock()
+
+    def chat(controller):
+        samples = []
+        for number in range(messages):
+            started = time.perf_counter()
+            controller.send(f"message {number}")
+            samples.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(samples)
+
+    threads = [threading.Thread(target=chat, args=(first,)) for first, _ in pairs]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - started
+
+
+def dead_client_eviction(simulation):
+    """A connection that never answers pings must be gone after dead_timeout."""
+    silent_socket = simulation.transport.connect(simulation.host, simulation.port)
+    simulation.settle()
+    connected = len(simulation.server.user_data_manager.get_users())
+
+    interval = simulation.server.heartbeat_interval
+    simulation.run_for(simulation.server.dead_timeout + 2 * interval, interval)
+    evicted = connected - len(simulation.server.user_data_manager.get_users())
+
+    silent_socket.close()
+    return evicted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory protocol simulation")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=50)
+    arguments = parser.parse_args()
+
+    report = sys.stdout
+    simulation = Simulation()
+
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        simulation.start()
+        controllers = [simulation.add_client(f"user{number}") for number in range(arguments.clients)]
+        pairs = list(zip(controllers[::2], controllers[1::2]))
+
+        race_failures = handshake_race(simulation, pairs)
+        latencies, elapsed = message_round_trips(pairs, arguments.messages)
+        evicted = dead_client_eviction(simulation)
+
+        simulation.stop()
+
+    print(f"clients:                 {arguments.clients}", file=report)
+    print(f"handshake races:         {len(pairs)} run, {race_failures} failed", file=report)
+    print(f"message requests:        {len(latencies)} in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.0f}/s)", file=report)
+    print(f"round trip p50 / p99:    {percentile(latencies, 0.5) * 1e6:.0f}us / "
+          f"{percentile(latencies, 0.99) * 1e6:.0f}us", file=report)
+    print(f"dead clients evicted:    {evicted}", file=report)
+    for direction, lane, frames, median, tail in simulation.server.lane_metrics.summary():
+        print(f"{direction + ' ' + lane + ' queued:':<25}{frames} frames, p50 / p99 "
+              f"{median * 1e6:.0f}us / {tail * 1e6:.0f}us", file=report)
+
+
+if __name__ == "__main__":
+    main()
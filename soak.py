@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import gc
+import os
+import resource
+import sys
+import threading
+
+from server import ClientSession
+from simulation import Simulation
+
+
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current size, steady growth still shows
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Soak:
+    """Clients connect, chat and leave over and over on simulated time while everything that could leak is sampled.
+
+    A few resident clients stay logged in for the whole run, so per-connection
+    state that only ever grows shows up there rather than being freed on close.
+    """
+
+    churning_clients = 20
+    resident_clients = 4
+    messages_per_pair = 5
+    # Simulated seconds per cycle, long enough for abandoned sessions to expire
+    cycle_time = 300
+    # Samples before this fraction of the run only set the baseline
+    warmup = 0.25
+    # How far a measurement may rise past its baseline before it counts as a leak
+    allowances = {
+        "rss": 16 * 1024 * 1024,
+        "threads": 2,
+        "objects": 2000,
+        "timers": 8,
+    }
+
+    def __init__(self):
+        self.simulation = Simulation()
+        self.server = self.simulation.server
+        self.client_pool = self.simulation.client_pool
+        self.residents = []
+        self.samples = []
+
+    def start(self):
+        self.simulation.start()
+        registrar = self.client_pool.open()
+        for number in range(self.churning_clients):
+            registrar.register(f"soak{number}", self.simulation.password)
+        self.client_pool.release(registrar)
+        self.residents = [self.simulation.add_client(f"resident{number}") for number in range(self.resident_clients)]
+        self.pair(self.residents)
+
+    def stop(self):
+        self.simulation.stop()
+
+    def in_parallel(self, calls):
+        threads = [threading.Thread(target=call) for call in calls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def pair(self, controllers):
+        # Whichever side arrives first waits for the other
+        calls = []
+        for first, second in zip(controllers[::2], controllers[1::2]):
+            calls.append(lambda first=first, second=second: first.connect(second.user_data.username))
+            calls.append(lambda first=first, second=second: second.connect(first.user_data.username))
+        self.in_parallel(calls)
+
+    def chat(self, controllers):
+        def talk(controller):
+            for number in range(self.messages_per_pair):
+                controller.send(f"soak message {number}")
+        self.in_parallel([lambda controller=controller: talk(controller) for controller in controllers[::2]])
+
+    def cycle(self):
+        controllers = []
+        for number in range(self.churning_clients):
+            controller = self.client_pool.open()
+            controller.login(f"soak{number}", self.simulation.password)
+            controllers.append(controller)
+        self.pair(controllers)
+        self.chat(controllers + self.residents)
+        for controller in self.residents:
+            controller.advertise()
+            controller.search("soak")
+
+        # Every way of leaving, the server must forget all of them
+        for number, controller in enumerate(controllers):
+            if number % 4 == 0:
+                controller.quit()
+                self.client_pool.release(controller)
+            elif number % 4 == 1:
+                # Dropped without a word, kept for resuming until the window passes
+                self.client_pool.release(controller)
+            else:
+                self.client_pool.release(controller, close=True)
+
+        self.simulation.run_for(self.cycle_time, self.server.heartbeat_interval)
+
+    def sizes(self):
+        user_data_manager = self.server.user_data_manager
+        return {
+            "sessions": len(user_data_manager.user_data),
+            "detached": len(user_data_manager.detached_sessions),
+            "accounts": len(user_data_manager.accounts),
+            "directory": len(user_data_manager.directory),
+            "timers": sum(len(slot) for slot in self.server.timer_wheel.slots),
+            "ip entries": len(self.server.admission.connections_per_ip),
+            "match queues": len(self.server.matchmaker.queues),
+            "read sockets": sum(len(reader.selector.get_map()) for reader in self.server.readers),
+            "pool clients": len(self.client_pool.controllers),
+            "pool sockets": len(self.client_pool.listener.selector.get_map()),
+            "waiting requests": sum(len(controller.request_helper.event_pool) for controller in self.residents),
+        }
+
+    def sample(self):
+        gc.collect()
+        objects = gc.get_objects()
+        sample = {
+            "rss": resident_memory(),
+            "threads": threading.active_count(),
+            "objects": len(objects),
+            # Anything holding on to a closed session holds its sockets and compression state too
+            "live sessions": sum(1 for item in objects if type(item) is ClientSession),
+        }
+        sample.update(self.sizes())
+        self.samples.append(sample)
+        return sample
+
+    def leaks(self):
+        """(name, baseline, final) for every measurement that kept growing after the warmup."""
+        start = max(1, int(len(self.samples) * self.warmup))
+        middle = start + (len(self.samples) - start) // 2
+        early, late = self.samples[start:middle], self.samples[middle:]
+        if not early or not late:
+            return []
+
+        found = []
+        for name in self.samples[0]:
+            baseline = max(sample[name] for sample in early)
+            final = max(sample[name] for sample in late)
+            if final - baseline > self.allowances.get(name, 0):
+                found.append((name, baseline, final))
+        return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accelerated soak run that fails on unbounded growth")
+    parser.add_argument("--cycles", type=int, default=200, help="each cycle is Soak.cycle_time simulated seconds")
+    parser.add_argument("--clients", type=int, default=Soak.churning_clients)
+    parser.add_argument("--report-every", type=int, default=10)
+    arguments = parser.parse_args()
+
+    report = sys.stdout
+    Soak.churning_clients = arguments.clients
+    soak = Soak()
+
+    columns = None
+    widths = {}
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        soak.start()
+        for number in range(1, arguments.cycles + 1):
+            soak.cycle()
+            sample = soak.sample()
+            if columns is None:
+                columns = list(sample)
+                widths = {name: max(len(name), 7) + 2 for name in columns}
+                print(f"{'cycle':>6}{'hours':>7}" + "".join(f"{name:>{widths[name]}}" for name in columns), file=report)
+            if number % arguments.report_every == 0 or number == arguments.cycles:
+                hours = number * soak.cycle_time / 3600
+                values = dict(sample, rss=f"{sample['rss'] / 2 ** 20:.1f}M")
+                print(f"{number:>6}{hours:>7.1f}" + "".join(f"{values[name]:>{widths[name]}}" for name in columns),
+                      file=report, flush=True)
+        soak.stop()
+
+    leaks = soak.leaks()
+    for name, baseline, final in leaks:
+        print(f"unbounded growth: {name} went from {baseline} to {final}", file=report)
+    if leaks:
+        sys.exit(1)
+    print("no unbounded growth", file=report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import itertools
+import json
+import queue
+import socket
+import zlib
+
+# Frames are newline terminated, Fernet tokens never contain a newline
+frame_delimiter = b"\n"
+
+# Preset dictionary for the compressed stream, the most common strings go last
+compression_dictionary = (
+    b'"address": "", "port": , "is_client": false, true, "target": "users": [], '
+    b'"resume_token": "", "token": "", "compression": "zlib", "hello", "ping", "pong", '
+    b'"login", "register", "advertise", "connect", "No partner", "quit": '
+    b'"password": "", "status": "failure", "message": "", "status": "success", '
+    b'"ID": {"command": "message", "username": "", "message": "'
+)
+
+
+class FrameCodec:
+    """Turns messages into encrypted, optionally compressed frames and back.
+
+    Compression uses one zlib stream per direction for the whole connection, so
+    encode must be called in the order frames go on the wire, and decode in the
+    order they arrive.
+    """
+
+    compression_level = 6
+
+    def __init__(self, fernet):
+        self.fernet = fernet
+        self.compressor = None
+        self.decompressor = None
+
+    def enable_compression(self):
+        self.compressor = zlib.compressobj(
+            self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=compression_dictionary
+        )
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=compression_dictionary)
+
+    def encode(self, data):
+        return self.encode_payload(json.dumps(data).encode())
+
+    def encode_payload(self, payload):
+        if self.compressor is not None:
+            payload = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self.fernet.encrypt(payload) + frame_delimiter
+
+    def decode(self, frame):
+        payload = self.fernet.decrypt(frame)
+        if self.decompressor is not None:
+            payload = self.decompressor.decompress(payload)
+        return json.loads(payload)
+
+
+class TcpTransport:
+    def __init__(self, no_delay=True, send_buffer_size=None, receive_buffer_size=None):
+        self.no_delay = no_delay
+        self.send_buffer_size = send_buffer_size
+        self.receive_buffer_size = receive_buffer_size
+
+    def set_buffer_sizes(self, tcp_socket):
+        # Set before listen or connect so the window scale is negotiated to match
+        if self.send_buffer_size:
+            tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        if self.receive_buffer_size:
+            tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+
+    def configure(self, tcp_socket):
+        # Frames are small and interactive, don't let Nagle hold them back
+        if self.no_delay:
+            tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def listen(self, host, port, backlog):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.set_buffer_sizes(server_socket)
+        server_socket.bind((host, port))
+        server_socket.listen(backlog)
+        return server_socket
+
+    def connect(self, host, port):
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.set_buffer_sizes(client_socket)
+        client_socket.connect((host, port))
+        self.configure(client_socket)
+        return client_socket
+
+
+class MemoryListener:
+    def __init__(self, transport, address):
+        self.transport = transport
+        self.address = address
+        self.pending = queue.Queue()
+        # One byte per queued connection so selectors see the listener as readable
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+
+    def enqueue(self, connection):
+        self.pending.put(connection)
+        self.wakeup_writer.send(b"\0")
+
+    def fileno(self):
+        return self.wakeup_reader.fileno()
+
+    def accept(self):
+        self.wakeup_reader.recv(1)
+        connection = self.pending.get()
+        if connection is None:
+            raise OSError("Listener closed")
+        return connection
+
+    def getsockname(self):
+        return self.address
+
+    def close(self):
+        self.transport.listeners.pop(self.address, None)
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+
+class MemoryTransport:
+    """Connects clients and servers in one process over socket pairs, no TCP stack involved.
+
+    Every connection gets its own fake peer address so per-IP limits treat
+    virtual clients as separate hosts.
+    """
+
+    def __init__(self):
+        self.listeners = {}
+        self.addresses = itertools.count(1)
+
+    def configure(self, memory_socket):
+        pass
+
+    def listen(self, host, port, backlog):
+        listener = MemoryListener(self, (host, port))
+        self.listeners[(host, port)] = listener
+        return listener
+
+    def connect(self, host, port):
+        listener = self.listeners.get((host, port))
+        if listener is None:
+            raise ConnectionRefusedError(f"Nothing listening on {host}:{port}")
+
+        client_socket, server_socket = socket.socketpair()
+        number = next(self.addresses)
+        listener.enqueue((server_socket, (f"memory-{number}", number)))
+        return client_socket